@@ -0,0 +1,284 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from dsp_codec import decode_dsp_adpcm_many, encode_dsp_adpcm, iter_decode_dsp_adpcm, _decode_dsp_adpcm_py
+from file_operations import write_wav, iter_wav_samples, resample_audio, pcm16_bytes
+from pcm_cache import PCMCache, DEFAULT_PCM_CACHE_BYTES
+from resampler import RESAMPLE_MODES
+from sound_operations import load_bank, extract_wavs, rebuild_container, sound_file_path
+from synthetic_bank import generate_bank
+
+SCALES = {
+    'small': {'num_sounds': 30, 'max_seconds': 2.0},
+    'medium': {'num_sounds': 100, 'max_seconds': 3.0},
+    'large': {'num_sounds': 400, 'max_seconds': 4.0, 'long_sounds': 2},
+}
+# Encoding is far slower than everything else, so the encode stage only
+# takes sounds until this many samples are queued.
+ENCODE_SAMPLE_LIMIT = 1 << 20
+
+# Round-trip bank and the digests the current codec produces for it. Any
+# change here means a change in the bytes written to disk or to the game.
+CHECK_BANK = {'num_sounds': 24, 'seed': 1, 'max_seconds': 1.5, 'long_sounds': 1, 'long_seconds': 6.0}
+CHECK_DIGESTS = {
+    'bank': "722863177849879ef7e58c7ea1021d1c",
+    'decode': "a0614d419bb9f411c744aa1350d678d5",
+    'encode': "9c35f6b5a04f18938b80b96b0f2954ad",
+    'extract': "5b71067e1ca2c657bdd96912f024563c",
+    'rebuild': "5d257f66700d30ef4f441843f7604a16",
+    'rebuild_incremental': "af3aab32be46abad39cf6e8d64e3a77a",
+    'resample_linear': "1b68b7939337d579260e6684de03ac2d",
+    'resample_sinc': "84adc731c8b93682de941fb998fea61e",
+}
+
+def digest(chunks):
+    h = hashlib.blake2b(digest_size=16)
+    for chunk in chunks:
+        h.update(chunk)
+    return h.hexdigest()
+
+def file_digest(paths):
+    def chunks():
+        for path in paths:
+            with open(path, "rb") as f:
+                yield f.read()
+    return digest(chunks())
+
+def decode_jobs(sounds):
+    return [(s.adpcm_data, s.coefficients, s.ps, s.num_samples) for s in sounds]
+
+def bank_samples(sounds):
+    return sum(s.num_samples for s in sounds)
+
+def measure(stage, samples, work, trace_memory):
+    start = time.perf_counter()
+    work()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if trace_memory:
+        # A separate traced pass, so tracing overhead stays out of the timing
+        tracemalloc.start()
+        try:
+            work()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+
+    return {
+        'stage': stage,
+        'seconds': seconds,
+        'samples': samples,
+        'samples_per_second': samples / seconds if seconds > 0 else None,
+        'peak_bytes': peak
+    }
+
+def run_scale(scale, workdir, trace_memory, report):
+    params = SCALES[scale]
+    bank_dir = os.path.join(workdir, scale)
+    os.makedirs(bank_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    uber_path, samp_path = generate_bank(bank_dir, "Bench", **params)
+    report(scale, {'stage': 'generate', 'seconds': time.perf_counter() - start, 'samples': None,
+                   'samples_per_second': None, 'peak_bytes': None})
+
+    sounds, _ = load_bank(uber_path, samp_path)
+    total = bank_samples(sounds)
+    report(scale, measure('load', total, lambda: load_bank(uber_path, samp_path), trace_memory))
+
+    report(scale, measure('decode', total, lambda: decode_dsp_adpcm_many(decode_jobs(sounds)), trace_memory))
+    pcm = decode_dsp_adpcm_many(decode_jobs(sounds))
+
+    encode_set = []
+    queued = 0
+    for sound_info, samples in zip(sounds, pcm):
+        if queued >= ENCODE_SAMPLE_LIMIT:
+            break
+        encode_set.append((samples, sound_info.coefficients))
+        queued += len(samples)
+    report(scale, measure('encode', queued,
+                          lambda: [encode_dsp_adpcm(samples, coefs) for samples, coefs in encode_set], trace_memory))
+
+    wav_dir = os.path.join(bank_dir, "wav")
+    os.makedirs(wav_dir, exist_ok=True)
+    wav_paths = [os.path.join(wav_dir, f"{s.index:04d}.wav") for s in sounds]
+
+    def write_all():
+        for path, sound_info, samples in zip(wav_paths, sounds, pcm):
+            write_wav(path, samples, sound_info.sample_rate)
+
+    def read_all():
+        for path in wav_paths:
+            for _ in iter_wav_samples(path):
+                pass
+
+    report(scale, measure('wav_write', total, write_all, trace_memory))
+    report(scale, measure('wav_read', total, read_all, trace_memory))
+    pcm = None
+
+    extract_base = os.path.join(bank_dir, "extract", "Bench")
+    os.makedirs(os.path.dirname(extract_base), exist_ok=True)
+    report(scale, measure('extract', total,
+                          lambda: extract_wavs(sounds, extract_base, PCMCache(DEFAULT_PCM_CACHE_BYTES, None)),
+                          trace_memory))
+    sounds = None
+
+    # Rebuild patches its inputs, so each pass starts from a fresh copy
+    # with every sound extracted next to it. The incremental pass finds
+    # nothing changed and measures the cost of checking.
+    rebuild_passes = [('rebuild', 1, False)]
+    if (os.cpu_count() or 1) > 1:
+        rebuild_passes.append(('rebuild_pool', os.cpu_count(), False))
+    rebuild_passes.append(('rebuild_unchanged', 1, True))
+    for stage, workers, incremental in rebuild_passes:
+        rebuild_dir = os.path.join(bank_dir, stage)
+
+        def prepare():
+            shutil.rmtree(rebuild_dir, ignore_errors=True)
+            os.makedirs(rebuild_dir)
+            for path in (uber_path, samp_path):
+                shutil.copy(path, rebuild_dir)
+            for name in os.listdir(os.path.dirname(extract_base)):
+                shutil.copy(os.path.join(os.path.dirname(extract_base), name), rebuild_dir)
+
+        def rebuild():
+            prepare()
+            rebuild_container(os.path.join(rebuild_dir, "Bench.uber"), os.path.join(rebuild_dir, "Bench.samp"),
+                              workers, incremental=incremental)
+
+        # Copying is a small share of a rebuild; it is timed along with it
+        # so traced and untraced passes see the same work.
+        report(scale, measure(stage, total, rebuild, trace_memory))
+
+    shutil.rmtree(bank_dir, ignore_errors=True)
+
+def run_checks(workdir):
+    # Returns {name: (expected, actual)} for every round-trip check
+    check_dir = os.path.join(workdir, "check")
+    shutil.rmtree(check_dir, ignore_errors=True)
+    os.makedirs(check_dir)
+    results = {}
+
+    uber_path, samp_path = generate_bank(check_dir, "Check", **CHECK_BANK)
+    results['bank'] = file_digest([uber_path, samp_path])
+
+    sounds, _ = load_bank(uber_path, samp_path)
+    pcm = decode_dsp_adpcm_many(decode_jobs(sounds))
+    results['decode'] = digest(pcm16_bytes(samples) for samples in pcm)
+
+    # Every decode path has to agree with the batched one
+    failures = []
+    for sound_info, samples in zip(sounds, pcm):
+        job = decode_jobs([sound_info])[0]
+        if list(_decode_dsp_adpcm_py(*job)) != list(samples):
+            failures.append(f"python decoder differs on sound {sound_info.index}")
+        streamed = [x for chunk in iter_decode_dsp_adpcm(*job, chunk_samples=5000) for x in chunk]
+        if streamed != list(samples):
+            failures.append(f"streaming decoder differs on sound {sound_info.index}")
+
+    results['encode'] = digest(bytes(encode_dsp_adpcm(samples, s.coefficients)) for s, samples in zip(sounds, pcm))
+
+    for mode in RESAMPLE_MODES:
+        results['resample_' + mode] = digest(pcm16_bytes(resample_audio(samples, s.sample_rate, 44100, mode))
+                                             for s, samples in zip(sounds[:4], pcm))
+
+    wav_path = os.path.join(check_dir, "roundtrip.wav")
+    write_wav(wav_path, pcm[0], sounds[0].sample_rate)
+    if [x for block in iter_wav_samples(wav_path) for x in block] != list(pcm[0]):
+        failures.append("WAV write/read round trip changed the samples")
+    os.remove(wav_path)
+
+    base_name = os.path.join(check_dir, "Check")
+    extract_wavs(sounds, base_name, PCMCache(DEFAULT_PCM_CACHE_BYTES, None))
+    wav_paths = [sound_file_path(base_name, s, "wav") for s in sounds]
+    results['extract'] = file_digest(wav_paths)
+
+    # Rebuild from the extracted WAVs, one of them reversed so the patch
+    # path writes audio that differs from the original.
+    reversed_samples = pcm[2][::-1]
+    write_wav(wav_paths[2], reversed_samples, sounds[2].sample_rate)
+    sounds = pcm = None
+
+    incremental_dir = os.path.join(check_dir, "incremental")
+    os.makedirs(incremental_dir)
+    for name in os.listdir(check_dir):
+        if name.startswith("Check"):
+            shutil.copy(os.path.join(check_dir, name), incremental_dir)
+
+    rebuild_container(uber_path, samp_path, incremental=False)
+    results['rebuild'] = file_digest([uber_path, samp_path])
+
+    # Only the edited sound may be encoded again
+    incremental_uber = os.path.join(incremental_dir, "Check.uber")
+    incremental_samp = os.path.join(incremental_dir, "Check.samp")
+    converted_count = rebuild_container(incremental_uber, incremental_samp)
+    if converted_count != 1:
+        failures.append(f"incremental rebuild re-encoded {converted_count} sounds instead of 1")
+    results['rebuild_incremental'] = file_digest([incremental_uber, incremental_samp])
+
+    shutil.rmtree(check_dir, ignore_errors=True)
+    checks = {name: (CHECK_DIGESTS.get(name), actual) for name, actual in results.items()}
+    return checks, failures
+
+def format_row(scale, row):
+    rate = f"{row['samples_per_second'] / 1e6:9.2f}" if row['samples_per_second'] else " " * 9
+    peak = f"{row['peak_bytes'] / (1 << 20):9.1f}" if row['peak_bytes'] is not None else " " * 9
+    return f"{scale:<8} {row['stage']:<13} {row['seconds']:9.3f} {rate} {peak}"
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time the codec and container pipeline on synthetic banks.")
+    parser.add_argument("--scales", nargs="+", choices=list(SCALES), default=["small", "medium"])
+    parser.add_argument("--workdir", help="where banks are generated (default: a temporary directory)")
+    parser.add_argument("--memory", action="store_true",
+                        help="repeat each stage under tracemalloc to report peak memory (much slower)")
+    parser.add_argument("--check-only", action="store_true", help="only run the round-trip checks")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="usm-bench-")
+    os.makedirs(workdir, exist_ok=True)
+
+    results = {'checks': {}, 'stages': []}
+    failed = False
+    try:
+        checks, failures = run_checks(workdir)
+        for name, (expected, actual) in checks.items():
+            ok = expected is None or expected == actual
+            failed = failed or not ok
+            results['checks'][name] = {'expected': expected, 'actual': actual, 'ok': ok}
+            print(f"check {name:<20} {'ok' if ok else 'CHANGED'} {actual}")
+        for failure in failures:
+            failed = True
+            print(f"check failed: {failure}")
+
+        if not args.check_only:
+            print(f"\n{'scale':<8} {'stage':<13} {'seconds':>9} {'Msamp/s':>9} {'peak MiB':>9}")
+
+            def report(scale, row):
+                row['scale'] = scale
+                results['stages'].append(row)
+                print(format_row(scale, row))
+                sys.stdout.flush()
+
+            for scale in args.scales:
+                run_scale(scale, workdir, args.memory, report)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,265 @@
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from file_operations import scan_container
+from instrumentation import Profiler, NULL_PROFILER
+from pcm_cache import PCMCache, DiskPCMCache, DEFAULT_PCM_CACHE_BYTES
+from resampler import RESAMPLE_MODES, DEFAULT_RESAMPLE_MODE
+from sound_operations import load_bank, extract_wavs, extract_dsps, rebuild_container, DEFAULT_WRITE_THREADS
+from workspace import Workspace, ExportIndex, DEDUPE_MODES
+
+def emit(event, **fields):
+    fields['event'] = event
+    sys.stdout.write(json.dumps(fields) + "\n")
+    sys.stdout.flush()
+
+def find_containers(paths):
+    pairs = []
+    for root_path in paths:
+        if os.path.isfile(root_path):
+            root_dir = os.path.dirname(root_path) or '.'
+            listings = [(root_dir, os.listdir(root_dir), [os.path.basename(root_path)])]
+        else:
+            root_dir = root_path
+            listings = ((d, files, files) for d, _, files in os.walk(root_path))
+
+        for directory, files, uber_candidates in listings:
+            samp_files = {}
+            for name in files:
+                stem, ext = os.path.splitext(name)
+                if ext.lower() == '.samp':
+                    samp_files[stem.lower()] = name
+
+            for name in sorted(uber_candidates):
+                stem, ext = os.path.splitext(name)
+                if ext.lower() != '.uber':
+                    continue
+                samp_name = samp_files.get(stem.lower())
+                if samp_name is None:
+                    emit("error", uber=os.path.join(directory, name), message="No matching .samp file")
+                    continue
+                pairs.append({
+                    'uber': os.path.join(directory, name),
+                    'samp': os.path.join(directory, samp_name),
+                    'relative_dir': os.path.relpath(directory, root_dir)
+                })
+    return pairs
+
+def output_base_name(container, output_dir):
+    stem = os.path.splitext(os.path.basename(container['uber']))[0]
+    if output_dir is None:
+        return os.path.join(os.path.dirname(container['uber']), stem)
+    target_dir = os.path.normpath(os.path.join(output_dir, container['relative_dir']))
+    os.makedirs(target_dir, exist_ok=True)
+    return os.path.join(target_dir, stem)
+
+def container_callbacks(uber_path, options):
+    verbose = options['verbose']
+
+    def log(text):
+        if verbose and text.strip():
+            emit("log", uber=uber_path, message=text.strip())
+
+    def progress(done, total):
+        emit("progress", uber=uber_path, done=done, total=total)
+
+    return log, progress
+
+def start_profiler(command, options):
+    if options['profile_dir'] is None:
+        return NULL_PROFILER
+    return Profiler(command, options['trace_memory']).start()
+
+def open_pcm_cache(options):
+    disk_cache = None
+    if not options['no_cache']:
+        try:
+            disk_cache = DiskPCMCache()
+        except OSError:
+            pass
+    return PCMCache(DEFAULT_PCM_CACHE_BYTES, disk_cache)
+
+def run_container(command, container, options):
+    uber_path = container['uber']
+    log, progress = container_callbacks(uber_path, options)
+    profiler = start_profiler(command, options)
+
+    start = time.perf_counter()
+
+    if command == "rebuild":
+        converted_count = rebuild_container(uber_path, container['samp'], options['workers'], log, progress,
+                                            options['resample'], profiler, not options['full'],
+                                            output_base_name(container, options['output_dir']))
+        write_profile(profiler, container, options)
+        return {'uber': uber_path, 'sounds': converted_count, 'seconds': time.perf_counter() - start}
+
+    sounds, _ = load_bank(uber_path, container['samp'], profiler)
+    base_name = output_base_name(container, options['output_dir'])
+
+    if command == "extract-wav":
+        pcm_cache = open_pcm_cache(options)
+        extract_wavs(sounds, base_name, pcm_cache, log, progress, options['start'], options['end'], profiler,
+                     writers=options['writers'], decode_workers=options['workers'])
+    else:
+        extract_dsps(sounds, base_name, log, progress, profiler, writers=options['writers'])
+
+    write_profile(profiler, container, options)
+    return {'uber': uber_path, 'sounds': len(sounds), 'seconds': time.perf_counter() - start}
+
+def write_profile(profiler, container, options):
+    if not profiler.enabled:
+        return
+    profiler.stop()
+    stem = os.path.splitext(os.path.basename(container['uber']))[0]
+    report_path = profiler.write_report(options['profile_dir'], stem)
+    emit("profile", uber=container['uber'], path=report_path, seconds=profiler.seconds,
+         stages=profiler.report()['stages'])
+
+def list_containers(containers):
+    failures = 0
+    for container in containers:
+        try:
+            sounds = scan_container(container['uber'])
+        except Exception as e:
+            failures += 1
+            emit("error", uber=container['uber'], message=str(e))
+            continue
+        for sound_info in sounds:
+            emit("sound", uber=container['uber'], index=sound_info.index,
+                 sample_rate=sound_info.sample_rate, num_samples=sound_info.num_samples,
+                 duration=round(sound_info.duration, 3))
+    return failures
+
+def run(command, containers, options):
+    failures = 0
+    jobs = min(options['jobs'], len(containers))
+
+    if jobs <= 1:
+        # A lone container gets the whole machine for its own encode pool
+        options['workers'] = options['jobs']
+        for container in containers:
+            try:
+                emit("done", **run_container(command, container, options))
+            except Exception as e:
+                failures += 1
+                emit("error", uber=container['uber'], message=str(e))
+        return failures
+
+    # Containers are spread across processes; each one encodes serially so
+    # the pool is not oversubscribed.
+    options['workers'] = 1
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(run_container, command, container, options): container
+                   for container in containers}
+        for future in as_completed(futures):
+            try:
+                emit("done", **future.result())
+            except Exception as e:
+                failures += 1
+                emit("error", uber=futures[future]['uber'], message=str(e))
+    return failures
+
+def run_workspace(command, containers, options):
+    # Every container is loaded into one workspace so a sample shared by
+    # several banks is decoded and written once, then linked or listed.
+    failures = 0
+    workspace = Workspace()
+    profilers = {}
+    for container in containers:
+        profiler = start_profiler(command, options)
+        try:
+            bank = workspace.add(container['uber'], container['samp'],
+                                 output_base_name(container, options['output_dir']), profiler)
+        except Exception as e:
+            failures += 1
+            emit("error", uber=container['uber'], message=str(e))
+            continue
+        profilers[bank['uber']] = (profiler, container)
+
+    total_bytes, unique_bytes = workspace.payload_bytes()
+    emit("workspace", containers=len(workspace.banks), sounds=workspace.sound_count(),
+         unique_sounds=workspace.unique_count(), duplicate_groups=len(workspace.duplicate_groups()),
+         payload_bytes=total_bytes, unique_payload_bytes=unique_bytes)
+
+    exports = ExportIndex(options['dedupe'])
+    pcm_cache = open_pcm_cache(options) if command == "extract-wav" else None
+    for bank in workspace.banks:
+        uber_path = bank['uber']
+        log, progress = container_callbacks(uber_path, options)
+        profiler, container = profilers[uber_path]
+        start = time.perf_counter()
+        try:
+            if command == "extract-wav":
+                extract_wavs(bank['sounds'], bank['base_name'], pcm_cache, log, progress, options['start'],
+                             options['end'], profiler, exports, options['writers'], options['jobs'])
+            else:
+                extract_dsps(bank['sounds'], bank['base_name'], log, progress, profiler, exports,
+                             options['writers'])
+            write_profile(profiler, container, options)
+            emit("done", uber=uber_path, sounds=len(bank['sounds']), seconds=time.perf_counter() - start)
+        except Exception as e:
+            failures += 1
+            emit("error", uber=uber_path, message=str(e))
+
+    emit("dedupe", mode=exports.mode, written=exports.written, linked=exports.linked, listed=exports.listed,
+         saved_bytes=exports.saved_bytes)
+    return failures
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract and rebuild UBER/SAMP sound banks without the GUI.")
+    parser.add_argument("command", choices=["list", "extract-wav", "extract-dsp", "rebuild"])
+    parser.add_argument("paths", nargs="+", help="UBER files or directories searched recursively")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1,
+                        help="number of worker processes (default: all cores)")
+    parser.add_argument("-o", "--output-dir", help="write extracted files here instead of next to each UBER "
+                        "(rebuild reads the edited files from here)")
+    parser.add_argument("--start", type=float, default=0, help="extract-wav: first second to export")
+    parser.add_argument("--end", type=float, help="extract-wav: export up to this second")
+    parser.add_argument("--resample", choices=RESAMPLE_MODES, default=DEFAULT_RESAMPLE_MODE,
+                        help="rebuild: how WAVs at a different rate are converted (default: %(default)s)")
+    parser.add_argument("--full", action="store_true",
+                        help="rebuild: re-encode every WAV, even ones unchanged since the last extract or rebuild")
+    parser.add_argument("--writers", type=int, default=DEFAULT_WRITE_THREADS, metavar="N",
+                        help="extract: files written at once per container (default: %(default)s)")
+    parser.add_argument("--no-cache", action="store_true", help="do not read or write the decoded PCM cache")
+    parser.add_argument("--dedupe", choices=DEDUPE_MODES,
+                        help="extract: write each distinct sample once across all containers and hard-link "
+                             "repeats to it ('link') or list them in <name>.duplicates.json ('manifest')")
+    parser.add_argument("--profile", metavar="DIR", help="write a per-stage timing report for each container to DIR")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="with --profile, also record peak memory per stage (slower)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="emit per-sound log events")
+    args = parser.parse_args(argv)
+
+    containers = find_containers(args.paths)
+    emit("start", command=args.command, containers=len(containers))
+
+    if args.command == "list":
+        return 1 if list_containers(containers) else 0
+
+    options = {
+        'output_dir': args.output_dir,
+        'no_cache': args.no_cache,
+        'start': max(0.0, args.start),
+        'end': args.end,
+        'resample': args.resample,
+        'full': args.full,
+        'profile_dir': args.profile,
+        'trace_memory': args.trace_memory,
+        'verbose': args.verbose,
+        'jobs': max(1, args.jobs),
+        'writers': max(1, args.writers),
+        'dedupe': args.dedupe
+    }
+    if args.dedupe and args.command != "rebuild":
+        failures = run_workspace(args.command, containers, options)
+    else:
+        failures = run(args.command, containers, options)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
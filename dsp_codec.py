@@ -1,4 +1,18 @@
 import struct
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Lanes are decoded side by side with NumPy while at least this many are
+# still active; the remaining long tails finish in a scalar loop.
+MIN_DECODE_LANES = 32
+DECODE_BATCH_SAMPLES = 1 << 22
+# hist1/hist2 are recorded every CHECKPOINT_FRAMES frames (3584 samples)
+CHECKPOINT_FRAMES = 256
+STREAM_CHUNK_SAMPLES = 1 << 16
 
 def nibbles_to_samples(nibbles):
     whole_frames = nibbles // 16
@@ -8,9 +22,221 @@ def nibbles_to_samples(nibbles):
     else:
         return whole_frames * 14
 
+def decodable_samples(data_len, num_samples):
+    frames, remainder = divmod(data_len, 8)
+    available = frames * 14 + max(0, remainder - 1) * 2
+    return max(0, min(num_samples, available))
+
 def decode_dsp_adpcm(data, coefs, ps_initial, num_samples):
-    hist1 = 0
-    hist2 = 0
+    if np is None:
+        return _decode_dsp_adpcm_py(data, coefs, ps_initial, num_samples)
+    return decode_dsp_adpcm_many([(data, coefs, ps_initial, num_samples)])[0]
+
+def decode_dsp_adpcm_many(jobs):
+    if np is None:
+        return [_decode_dsp_adpcm_py(*job) for job in jobs]
+
+    lengths = [decodable_samples(len(job[0]), job[3]) for job in jobs]
+    order = sorted(range(len(jobs)), key=lambda i: lengths[i], reverse=True)
+    results = [None] * len(jobs)
+
+    batch = []
+    batch_samples = 0
+    for i in order:
+        if batch and batch_samples + lengths[i] > DECODE_BATCH_SAMPLES:
+            _decode_lanes([jobs[j] for j in batch], [lengths[j] for j in batch], batch, results)
+            batch = []
+            batch_samples = 0
+        batch.append(i)
+        batch_samples += lengths[i]
+    if batch:
+        _decode_lanes([jobs[j] for j in batch], [lengths[j] for j in batch], batch, results)
+
+    return results
+
+def _decode_lanes(jobs, lengths, slots, results):
+    # jobs arrive sorted by length, longest first, so the lanes still active
+    # at any frame are always a prefix of the batch.
+    lane_frames = [(n + 13) // 14 for n in lengths]
+    frame_base = np.zeros(len(jobs) + 1, dtype=np.int64)
+    np.cumsum(lane_frames, out=frame_base[1:])
+    total_frames = int(frame_base[-1])
+
+    excitation = np.zeros((total_frames, 14), dtype=np.int64)
+    coef1 = np.zeros(total_frames, dtype=np.int64)
+    coef2 = np.zeros(total_frames, dtype=np.int64)
+
+    for lane, (data, coefs, ps_initial, num_samples) in enumerate(jobs):
+        frames = lane_frames[lane]
+        if frames == 0:
+            continue
+        start = int(frame_base[lane])
+        excitation[start:start + frames], coef1[start:start + frames], coef2[start:start + frames] = \
+            _unpack_frames(data, coefs, frames)
+
+    output = np.zeros((total_frames, 14), dtype=np.int16)
+    hist1 = np.zeros(len(jobs), dtype=np.int64)
+    hist2 = np.zeros(len(jobs), dtype=np.int64)
+    frame_counts = np.array(lane_frames, dtype=np.int64)
+
+    frame = 0
+    active = int(np.count_nonzero(frame_counts > 0))
+    while active >= MIN_DECODE_LANES:
+        rows = frame_base[:active] + frame
+        exc = excitation[rows]
+        c1 = coef1[rows]
+        c2 = coef2[rows]
+        h1 = hist1[:active]
+        h2 = hist2[:active]
+        block = np.empty((active, 14), dtype=np.int64)
+        for j in range(14):
+            sample = exc[:, j] + c1 * h1 + c2 * h2
+            sample += 1024
+            sample >>= 11
+            np.clip(sample, -32768, 32767, out=sample)
+            block[:, j] = sample
+            h2 = h1
+            h1 = sample
+        hist1[:active] = h1
+        hist2[:active] = h2
+        output[rows] = block
+        frame += 1
+        active = int(np.count_nonzero(frame_counts[:active] > frame))
+
+    for lane in range(active):
+        start = int(frame_base[lane])
+        end = start + lane_frames[lane]
+        output[start + frame:end] = _decode_lane_tail(
+            excitation[start + frame:end], coef1[start + frame:end], coef2[start + frame:end],
+            int(hist1[lane]), int(hist2[lane]))
+
+    flat = output.reshape(-1)
+    for lane, slot in enumerate(slots):
+        start = int(frame_base[lane]) * 14
+        results[slot] = flat[start:start + lengths[lane]].tolist()
+
+def _unpack_frames(data, coefs, frames):
+    coef_table = np.frombuffer(bytes(coefs[:32]), dtype=">i2").astype(np.int64).reshape(8, 2)
+
+    raw = np.frombuffer(data, dtype=np.uint8)[:frames * 8]
+    block = np.zeros(frames * 8, dtype=np.uint8)
+    block[:len(raw)] = raw
+    block = block.reshape(frames, 8)
+
+    ps = block[:, 0]
+    predictor = (ps >> 4) & 0x0F
+    predictor[predictor >= 8] = 0
+    scale = (ps & 0x0F).astype(np.int64)
+
+    nibbles = np.empty((frames, 14), dtype=np.int64)
+    nibbles[:, 0::2] = block[:, 1:] >> 4
+    nibbles[:, 1::2] = block[:, 1:] & 0x0F
+    nibbles[nibbles >= 8] -= 16
+
+    excitation = (nibbles << scale[:, None]) << 11
+    return excitation, coef_table[predictor, 0], coef_table[predictor, 1]
+
+def _decode_lane_tail(excitation, coef1, coef2, hist1, hist2):
+    samples = []
+    append = samples.append
+    flat = excitation.reshape(-1).tolist()
+    pos = 0
+    for c1, c2 in zip(coef1.tolist(), coef2.tolist()):
+        for exc in flat[pos:pos + 14]:
+            sample = (exc + c1 * hist1 + c2 * hist2 + 1024) >> 11
+            if sample > 32767:
+                sample = 32767
+            elif sample < -32768:
+                sample = -32768
+            append(sample)
+            hist2 = hist1
+            hist1 = sample
+        pos += 14
+    return np.array(samples, dtype=np.int16).reshape(-1, 14)
+
+def iter_decode_dsp_adpcm(data, coefs, ps_initial, num_samples, start=0, end=None,
+                          chunk_samples=STREAM_CHUNK_SAMPLES, checkpoints=None, record=None):
+    # Yields array('h') blocks covering samples [start, end). With a
+    # checkpoint index only the frames from the nearest checkpoint on are decoded.
+    # The history at every checkpoint passed is appended to record, if given.
+    total = decodable_samples(len(data), num_samples)
+    end = total if end is None else max(0, min(end, total))
+    if start >= end:
+        return
+
+    if checkpoints is not None:
+        frame, hist1, hist2 = checkpoints.lookup(start)
+    else:
+        frame, hist1, hist2 = 0, 0, 0
+
+    chunk_frames = max(1, chunk_samples // 14)
+    skip = start - frame * 14
+    while frame * 14 < end:
+        count = min(chunk_frames * 14, end - frame * 14)
+        block = _decode_frame_range(data[frame * 8:], coefs, count, hist1, hist2)
+        if record is not None:
+            record.extend(frame, block)
+        if len(block) >= 2:
+            hist1, hist2 = block[-1], block[-2]
+        frame += chunk_frames
+
+        if skip >= len(block):
+            skip -= len(block)
+            continue
+        yield array('h', block[skip:] if skip else block)
+        skip = 0
+
+def _decode_frame_range(data, coefs, num_samples, hist1, hist2):
+    if np is None:
+        return _decode_dsp_adpcm_py(data, coefs, 0, num_samples, hist1, hist2)
+
+    frames = (num_samples + 13) // 14
+    excitation, coef1, coef2 = _unpack_frames(data, coefs, frames)
+    return _decode_lane_tail(excitation, coef1, coef2, hist1, hist2).reshape(-1)[:num_samples].tolist()
+
+class DecodeCheckpoints:
+    def __init__(self, interval_frames, history):
+        self.interval_frames = interval_frames
+        self.history = history
+
+    @classmethod
+    def from_pcm(cls, pcm, interval_frames=CHECKPOINT_FRAMES):
+        history = array('h')
+        for frame in range(0, (len(pcm) + 13) // 14, interval_frames):
+            first = frame * 14
+            history.append(pcm[first - 1] if first >= 1 else 0)
+            history.append(pcm[first - 2] if first >= 2 else 0)
+        return cls(interval_frames, history)
+
+    @classmethod
+    def build(cls, data, coefs, ps_initial, num_samples, interval_frames=CHECKPOINT_FRAMES):
+        history = array('h', (0, 0))
+        for block in iter_decode_dsp_adpcm(data, coefs, ps_initial, num_samples,
+                                           chunk_samples=interval_frames * 14):
+            if len(block) == interval_frames * 14:
+                history.append(block[-1])
+                history.append(block[-2])
+        return cls(interval_frames, history)
+
+    def extend(self, frame, block):
+        # Adds the checkpoints inside a block decoded from frame on; decoding
+        # always starts at or before the last checkpoint already recorded.
+        checkpoint = len(self.history) // 2
+        offset = (checkpoint * self.interval_frames - frame) * 14
+        while 0 < offset <= len(block):
+            self.history.append(block[offset - 1])
+            self.history.append(block[offset - 2])
+            offset += self.interval_frames * 14
+
+    def copy(self):
+        return DecodeCheckpoints(self.interval_frames, array('h', self.history))
+
+    def lookup(self, sample):
+        checkpoint = min(sample // 14 // self.interval_frames, len(self.history) // 2 - 1)
+        return (checkpoint * self.interval_frames, self.history[checkpoint * 2],
+                self.history[checkpoint * 2 + 1])
+
+def _decode_dsp_adpcm_py(data, coefs, ps_initial, num_samples, hist1=0, hist2=0):
     samples = []
 
     coef_table = []
@@ -70,6 +296,8 @@ def decode_dsp_adpcm(data, coefs, ps_initial, num_samples):
 
     return samples
 
+ENCODE_BLOCK_FRAMES = 4096
+
 def encode_dsp_adpcm(samples, coefs):
     encoded = bytearray()
     hist1 = 0
@@ -81,83 +309,77 @@ def encode_dsp_adpcm(samples, coefs):
         c2 = struct.unpack(">h", coefs[i*4+2:i*4+4])[0]
         coef_table.append((c1, c2))
 
-    i = 0
-    while i < len(samples):
-        frame_samples = samples[i:i+14]
-        if len(frame_samples) == 0:
-            break
+    for frame_samples, tail_errors in _iter_encode_frames(samples, coef_table):
+        m = len(frame_samples)
+        s0 = frame_samples[0]
+        s1 = frame_samples[1] if m > 1 else 0
 
+        # Prediction error of the first two samples depends on the
+        # reconstructed history; the rest was scored ahead of time.
         best_predictor = 0
-        best_error = float('inf')
-
+        best_error = None
         for predictor in range(8):
-            error = 0
-            temp_h1 = hist1
-            temp_h2 = hist2
-            for sample in frame_samples:
-                predicted = (coef_table[predictor][0] * temp_h1 + coef_table[predictor][1] * temp_h2) >> 11
-                error += abs(sample - predicted)
-                temp_h2 = temp_h1
-                temp_h1 = sample
-            if error < best_error:
+            c1, c2 = coef_table[predictor]
+            error = tail_errors[predictor] + abs(s0 - ((c1 * hist1 + c2 * hist2) >> 11))
+            if m > 1:
+                error += abs(s1 - ((c1 * s0 + c2 * hist1) >> 11))
+            if best_error is None or error < best_error:
                 best_error = error
                 best_predictor = predictor
 
+        c1, c2 = coef_table[best_predictor]
         scale = 0
         best_scale_error = float('inf')
+        best_nibbles = None
+        best_hist = None
 
         for test_scale in range(0, 13):
             temp_hist1 = hist1
             temp_hist2 = hist2
             max_quantized = 0
+            nibbles = []
 
             for sample in frame_samples:
-                predicted = (coef_table[best_predictor][0] * temp_hist1 + coef_table[best_predictor][1] * temp_hist2) >> 11
-                diff = sample - predicted
+                prediction = c1 * temp_hist1 + c2 * temp_hist2
+                diff = sample - (prediction >> 11)
 
                 nibble = diff >> test_scale
-                nibble = max(-8, min(7, nibble))
+                if nibble > 7:
+                    nibble = 7
+                elif nibble < -8:
+                    nibble = -8
 
-                reconstructed = (nibble << test_scale) << 11
-                reconstructed = (reconstructed + coef_table[best_predictor][0] * temp_hist1 + coef_table[best_predictor][1] * temp_hist2 + 1024) >> 11
-                reconstructed = max(-32768, min(32767, reconstructed))
+                reconstructed = (((nibble << test_scale) << 11) + prediction + 1024) >> 11
+                if reconstructed > 32767:
+                    reconstructed = 32767
+                elif reconstructed < -32768:
+                    reconstructed = -32768
 
                 error = abs(sample - reconstructed)
                 if error > max_quantized:
                     max_quantized = error
+                    # A scale that can no longer beat the best one is
+                    # neither selected nor able to end the search.
+                    if max_quantized >= best_scale_error:
+                        break
 
+                nibbles.append(nibble & 0x0F)
                 temp_hist2 = temp_hist1
                 temp_hist1 = reconstructed
+            else:
+                if max_quantized < best_scale_error:
+                    best_scale_error = max_quantized
+                    scale = test_scale
+                    best_nibbles = nibbles
+                    best_hist = (temp_hist1, temp_hist2)
 
-            if max_quantized < best_scale_error:
-                best_scale_error = max_quantized
-                scale = test_scale
-
-            if max_quantized < 256:
-                break
+                if max_quantized < 256:
+                    break
 
         ps_byte = (best_predictor << 4) | scale
         encoded.append(ps_byte)
 
-        temp_hist1 = hist1
-        temp_hist2 = hist2
-        nibbles = []
-
-        for sample in frame_samples:
-            predicted = (coef_table[best_predictor][0] * temp_hist1 + coef_table[best_predictor][1] * temp_hist2) >> 11
-            diff = sample - predicted
-
-            nibble = diff >> scale
-            nibble = max(-8, min(7, nibble))
-            nibbles.append(nibble & 0x0F)
-
-            reconstructed = (nibble << scale) << 11
-            reconstructed = (reconstructed + coef_table[best_predictor][0] * temp_hist1 + coef_table[best_predictor][1] * temp_hist2 + 1024) >> 11
-            reconstructed = max(-32768, min(32767, reconstructed))
-
-            temp_hist2 = temp_hist1
-            temp_hist1 = reconstructed
-
+        nibbles = best_nibbles
         while len(nibbles) < 14:
             nibbles.append(0)
 
@@ -165,14 +387,50 @@ def encode_dsp_adpcm(samples, coefs):
             byte = (nibbles[j] << 4) | nibbles[j+1]
             encoded.append(byte)
 
-        hist1 = temp_hist1
-        hist2 = temp_hist2
-        i += 14
+        hist1, hist2 = best_hist
 
     return bytes(encoded)
 
-def create_dsp_file(num_samples, num_nibbles, sample_rate, coefficients, ps, adpcm_data):
-    dspbuf = bytearray(96 + len(adpcm_data))
+def _iter_encode_frames(samples, coef_table):
+    if np is None:
+        for i in range(0, len(samples), 14):
+            frame_samples = list(samples[i:i+14])
+            yield frame_samples, _predictor_tail_errors_py(frame_samples, coef_table)
+        return
+
+    samples = np.asarray(samples).astype(np.int64)
+    coef1 = np.array([c[0] for c in coef_table], dtype=np.int64)
+    coef2 = np.array([c[1] for c in coef_table], dtype=np.int64)
+
+    for start in range(0, len(samples), ENCODE_BLOCK_FRAMES * 14):
+        block = samples[start:start + ENCODE_BLOCK_FRAMES * 14]
+        frames = (len(block) + 13) // 14
+        padded = np.zeros(frames * 14, dtype=np.int64)
+        padded[:len(block)] = block
+        padded = padded.reshape(frames, 14)
+
+        predicted = (coef1 * padded[:, 1:13, None] + coef2 * padded[:, 0:12, None]) >> 11
+        errors = np.abs(padded[:, 2:, None] - predicted)
+        last = len(block) - (frames - 1) * 14
+        errors[-1, max(0, last - 2):] = 0
+        tail_errors = errors.sum(axis=1).tolist()
+
+        rows = padded.tolist()
+        rows[-1] = rows[-1][:last]
+        yield from zip(rows, tail_errors)
+
+def _predictor_tail_errors_py(frame_samples, coef_table):
+    tail_errors = []
+    for c1, c2 in coef_table:
+        error = 0
+        for j in range(2, len(frame_samples)):
+            predicted = (c1 * frame_samples[j-1] + c2 * frame_samples[j-2]) >> 11
+            error += abs(frame_samples[j] - predicted)
+        tail_errors.append(error)
+    return tail_errors
+
+def create_dsp_header(num_samples, num_nibbles, sample_rate, coefficients, ps):
+    dspbuf = bytearray(96)
 
     dspbuf[0x00:0x04] = struct.pack(">I", num_samples)
     dspbuf[0x04:0x08] = struct.pack(">I", num_nibbles)
@@ -192,6 +450,4 @@ def create_dsp_file(num_samples, num_nibbles, sample_rate, coefficients, ps, adp
     dspbuf[0x48:0x4A] = struct.pack(">H", 0)
     dspbuf[0x4A:0x60] = b"\0" * 22
 
-    dspbuf[0x60:len(dspbuf)] = adpcm_data
-
     return dspbuf
@@ -1,154 +1,504 @@
+import mmap
 import os
+import shutil
 import struct
-import wave
-from dsp_codec import nibbles_to_samples, decode_dsp_adpcm, create_dsp_file
-
-def extract_sdir_from_uber(uber_path, silent=False):
-    uber_size = os.path.getsize(uber_path)
-    sdir_path = None
-
-    with open(uber_path, "rb") as uber:
-        uber.seek(0x08)
-        offsets = []
-        offset = struct.unpack(">I", uber.read(4))[0]
-        offsets.append(offset)
-
-        while uber.tell() < offsets[0]:
-            offset = struct.unpack(">I", uber.read(4))[0]
-            offsets.append(offset)
+import sys
+import tempfile
+from array import array
+from dsp_codec import nibbles_to_samples, create_dsp_header, encode_dsp_adpcm
+from resampler import resample_stream, DEFAULT_RESAMPLE_MODE
+from instrumentation import Profiler, NULL_PROFILER
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+WAV_CHUNK_FRAMES = 1 << 16
+PATCH_COPY_BUFFER = 1 << 20
+
+# offset, nibble count, sample rate, coefficients, initial ps byte
+SDIR_ENTRY = struct.Struct(">II6xH32s3xB12x")
+
+WAV_NUMPY_DTYPES = {
+    "int8": "<u1",
+    "int16": "<i2",
+    "int32": "<i4",
+    "float32": "<f4",
+    "float64": "<f8"
+}
+WAV_ARRAY_TYPECODES = {
+    "int8": "B",
+    "int16": "h",
+    "int32": "i",
+    "float32": "f",
+    "float64": "d"
+}
+
+class UberContainer:
+    def __init__(self, uber_path):
+        self.path = uber_path
+        self.data = map_file(uber_path)
+        self.chunk_offsets = self._read_chunk_offsets()
+
+    def _read_chunk_offsets(self):
+        uber_size = len(self.data)
+        if uber_size < 0x0C:
+            raise ValueError(f"{os.path.basename(self.path)} is too small to be an UBER file")
+
+        table_end = struct.unpack_from(">I", self.data, 0x08)[0]
+        if table_end < 0x0C or table_end > uber_size:
+            raise ValueError(f"{os.path.basename(self.path)} has an invalid chunk table")
+
+        count = (table_end - 0x08 + 3) // 4
+        offsets = list(struct.unpack_from(f">{count}I", self.data, 0x08))
         offsets.append(uber_size)
+        return offsets
+
+    def __len__(self):
+        return len(self.chunk_offsets) - 1
+
+    def chunk(self, i):
+        start = min(self.chunk_offsets[i], len(self.data))
+        end = max(start, min(self.chunk_offsets[i + 1], len(self.data)))
+        return self.data[start:end]
+
+    def chunk_type(self, i):
+        try:
+            return bytes(self.chunk(i)[0:4])[::-1].decode("ascii").lower()
+        except UnicodeDecodeError:
+            return ""
+
+    def find_chunk(self, chunk_type):
+        for i in range(len(self)):
+            if self.chunk_type(i) == chunk_type:
+                return i
+        return None
+
+    @property
+    def sdir_offset(self):
+        i = self.find_chunk("sdir")
+        return self.chunk_offsets[i] if i is not None else None
+
+    @property
+    def sdir(self):
+        i = self.find_chunk("sdir")
+        return self.chunk(i) if i is not None else None
+
+    def close(self):
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+class SoundEntry:
+    # One SDIR entry. Thousands of these stay alive for a loaded container,
+    # so derived fields are computed on access rather than stored.
+    __slots__ = ('index', 'sample_rate', 'num_nibbles', 'num_samples', 'coefficients', 'ps', 'samp_offset',
+                 'adpcm_data', 'content_key')
+
+    def __init__(self, index, sample_rate, num_nibbles, coefficients, ps, samp_offset):
+        self.index = index
+        self.sample_rate = sample_rate
+        self.num_nibbles = num_nibbles
+        self.num_samples = nibbles_to_samples(num_nibbles)
+        self.coefficients = coefficients
+        self.ps = ps
+        self.samp_offset = samp_offset
+        # A view into the mapped SAMP, set by load_sound_data
+        self.adpcm_data = None
+        # Filled in by pcm_content_key the first time it is needed
+        self.content_key = None
+
+    @property
+    def duration(self):
+        return self.num_samples / self.sample_rate if self.sample_rate > 0 else 0
+
+    @property
+    def samp_length(self):
+        return self.num_nibbles // 2
+
+    @property
+    def sdir_entry_offset(self):
+        return 16 + self.index * SDIR_ENTRY.size
+
+    @property
+    def dsp_header(self):
+        return create_dsp_header(self.num_samples, self.num_nibbles, self.sample_rate, self.coefficients, self.ps)
+
+def build_rebuild_index(sdir_offset, sounds):
+    if sdir_offset is None:
+        return None
+
+    rebuild_index = {}
+    for sound_info in sounds:
+        rebuild_index[sound_info.index] = {
+            'uber_offset': sdir_offset + sound_info.sdir_entry_offset + 0x10,
+            'samp_offset': sound_info.samp_offset,
+            'samp_length': len(sound_info.adpcm_data)
+        }
+    return rebuild_index
+
+def scan_sdir(sdir_data):
+    entries = []
+
+    sdirhead = bytes(sdir_data[0:16])
+
+    if sdirhead[0:4][::-1] != b"SDIR":
+        return entries
+
+    num_samples = struct.unpack(">I", sdirhead[0x0C:0x10])[0]
+
+    table = bytes(sdir_data[16:16 + num_samples * SDIR_ENTRY.size])
+    table += b"\0" * (-len(table) % SDIR_ENTRY.size)
+
+    for i, (sample_offset, num_nibbles, sample_rate, coefficients, ps) in enumerate(SDIR_ENTRY.iter_unpack(table)):
+        if num_nibbles > 0:
+            entries.append(SoundEntry(i, sample_rate, num_nibbles, coefficients, ps,
+                                      max(0, (sample_offset - 2) // 2)))
+
+    return entries
+
+def scan_container(uber_path):
+    with UberContainer(uber_path) as container:
+        sdir = container.sdir
+        return scan_sdir(sdir) if sdir is not None else []
+
+def load_sound_data(sdir_data, samp_path):
+    if isinstance(sdir_data, (str, os.PathLike)):
+        with open(sdir_data, "rb") as sdir:
+            sdir_data = sdir.read()
+
+    sounds = scan_sdir(sdir_data)
+    if not sounds:
+        return sounds
+
+    samp_view = map_file(samp_path)
+
+    for sound_info in sounds:
+        start = sound_info.samp_offset
+        sound_info.adpcm_data = samp_view[start:start + sound_info.samp_length]
 
-        i = 0
-        while uber.tell() < uber_size and i < len(offsets):
-            size = offsets[i+1] - uber.tell()
-            outbuf = uber.read(size)
-
-            try:
-                file_type = outbuf[0:4][::-1].decode("ascii").lower()
-            except:
-                file_type = ""
+    return sounds
 
-            if file_type == "sdir":
-                sdir_path = os.path.splitext(uber_path)[0] + ".sdir"
-                with open(sdir_path, "wb") as out:
-                    out.write(outbuf)
+def map_file(file_path):
+    # The returned view keeps the mapping alive; it is released once the
+    # last slice taken from it is dropped.
+    with open(file_path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return memoryview(b"")
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+def write_dsp_file(dsp_path, dsp_header, adpcm_data):
+    with open(dsp_path, 'wb') as dsp:
+        dsp.write(dsp_header)
+        dsp.write(adpcm_data)
+
+def read_wav_info(wav_file):
+    riff = wav_file.read(12)
+    if len(riff) < 12 or riff[0:4] != b"RIFF" or riff[8:12] != b"WAVE":
+        raise ValueError("Not a RIFF/WAVE file")
+
+    info = None
+    while True:
+        chunk_header = wav_file.read(8)
+        if len(chunk_header) < 8:
+            raise ValueError("WAV file has no data chunk")
+
+        chunk_id, chunk_size = struct.unpack("<4sI", chunk_header)
+
+        if chunk_id == b"fmt ":
+            fmt = wav_file.read(chunk_size)
+            format_tag, channels, sample_rate, _, block_align, bits = struct.unpack("<HHIIHH", fmt[:16])
+            if format_tag == WAVE_FORMAT_EXTENSIBLE and len(fmt) >= 26:
+                format_tag = struct.unpack("<H", fmt[24:26])[0]
+            if chunk_size % 2:
+                wav_file.read(1)
+
+            if format_tag == WAVE_FORMAT_PCM and bits in (8, 16, 24, 32):
+                sample_format = f"int{bits}"
+            elif format_tag == WAVE_FORMAT_IEEE_FLOAT and bits in (32, 64):
+                sample_format = f"float{bits}"
+            else:
+                raise ValueError(f"Unsupported WAV format (tag 0x{format_tag:04X}, {bits}-bit)")
+
+            if channels == 0 or block_align != channels * (bits // 8):
+                raise ValueError("Invalid WAV block alignment")
+
+            info = {
+                'sample_rate': sample_rate,
+                'channels': channels,
+                'sample_format': sample_format,
+                'block_align': block_align
+            }
+        elif chunk_id == b"data":
+            if info is None:
+                raise ValueError("WAV data chunk appears before fmt chunk")
+
+            data_offset = wav_file.tell()
+            file_size = os.fstat(wav_file.fileno()).st_size
+            data_size = min(chunk_size, file_size - data_offset)
+            info['data_offset'] = data_offset
+            info['num_frames'] = data_size // info['block_align']
+            return info
+        else:
+            wav_file.seek(chunk_size + (chunk_size % 2), os.SEEK_CUR)
+
+def iter_wav_samples(wav_path, chunk_frames=WAV_CHUNK_FRAMES):
+    with open(wav_path, 'rb') as wav_file:
+        info = read_wav_info(wav_file)
+        remaining = info['num_frames']
+
+        while remaining > 0:
+            frames = min(chunk_frames, remaining)
+            raw = wav_file.read(frames * info['block_align'])
+            frames = len(raw) // info['block_align']
+            if frames == 0:
                 break
-            i += 1
-
-    return sdir_path
-
-def load_sound_data(sdir_path, samp_path):
-    sounds = []
-
-    with open(sdir_path, "rb") as sdir:
-        sdirhead = bytearray(16)
-        sdir.readinto(sdirhead)
-
-        if sdirhead[0:4][::-1] != b"SDIR":
-            return sounds
-
-        num_samples = struct.unpack(">I", sdirhead[0x0C:0x10])[0]
-
-        with open(samp_path, "rb") as samp:
-            for i in range(num_samples):
-                sampinfo = bytearray(64)
-                sdir.readinto(sampinfo)
-
-                sample_offset = struct.unpack(">I", sampinfo[0x00:0x04])[0]
-                num_nibbles = struct.unpack(">I", sampinfo[0x04:0x08])[0]
-                sample_rate = struct.unpack(">H", sampinfo[0x0E:0x10])[0]
-                coefficients = sampinfo[0x10:0x30]
-                ps = sampinfo[0x33]
-
-                if num_nibbles > 0:
-                    num_samples_calc = nibbles_to_samples(num_nibbles)
-
-                    samp.seek((sample_offset - 2) // 2)
-                    adpcm_data = samp.read(num_nibbles // 2)
 
-                    dsp_data = create_dsp_file(num_samples_calc, num_nibbles, sample_rate,
-                                                    coefficients, ps, adpcm_data)
-
-                    pcm_samples = decode_dsp_adpcm(adpcm_data, coefficients, ps, num_samples_calc)
-
-                    sound_info = {
-                        'index': i,
-                        'sample_rate': sample_rate,
-                        'num_samples': num_samples_calc,
-                        'duration': num_samples_calc / sample_rate if sample_rate > 0 else 0,
-                        'dsp_data': dsp_data,
-                        'pcm_samples': pcm_samples,
-                        'coefficients': coefficients,
-                        'ps': ps,
-                        'adpcm_data': adpcm_data
-                    }
-                    sounds.append(sound_info)
-
-    return sounds
+            yield _wav_block_to_mono16(raw[:frames * info['block_align']], info)
+            remaining -= frames
 
 def read_wav_file(wav_path):
-    with wave.open(wav_path, 'rb') as wav:
-        sample_rate = wav.getframerate()
-        num_channels = wav.getnchannels()
-        num_samples = wav.getnframes()
-        audio_data = wav.readframes(num_samples)
-
-        samples = []
-
-        if num_channels == 2:
-            for i in range(0, len(audio_data), 4):
-                left = struct.unpack('<h', audio_data[i:i+2])[0]
-                right = struct.unpack('<h', audio_data[i+2:i+4])[0]
-                mono_sample = (left + right) // 2
-                samples.append(mono_sample)
+    with open(wav_path, 'rb') as wav_file:
+        sample_rate = read_wav_info(wav_file)['sample_rate']
+
+    samples = array('h')
+    for block in iter_wav_samples(wav_path):
+        samples.extend(block)
+
+    return samples, sample_rate
+
+def _wav_block_to_mono16(raw, info):
+    sample_format = info['sample_format']
+    channels = info['channels']
+
+    if sample_format == "int24":
+        # Widen each 24-bit sample to a 32-bit one by prepending a zero byte.
+        widened = bytearray(len(raw) // 3 * 4)
+        widened[1::4] = raw[0::3]
+        widened[2::4] = raw[1::3]
+        widened[3::4] = raw[2::3]
+        raw = widened
+        sample_format = "int32"
+
+    if np is not None:
+        values = np.frombuffer(raw, dtype=WAV_NUMPY_DTYPES[sample_format]).reshape(-1, channels)
+
+        if sample_format.startswith("float"):
+            mixed = values.astype(np.float64).sum(axis=1) / channels
+            mixed = np.clip(np.round(mixed * 32767), -32768, 32767)
         else:
-            for i in range(0, len(audio_data), 2):
-                sample = struct.unpack('<h', audio_data[i:i+2])[0]
-                samples.append(sample)
-
-        return samples, sample_rate
+            mixed = values.astype(np.int64).sum(axis=1) // channels
+            if sample_format == "int8":
+                mixed = (mixed - 128) << 8
+            elif sample_format == "int32":
+                mixed >>= 16
+
+        return array('h', mixed.astype(np.int16).tobytes())
+
+    values = array(WAV_ARRAY_TYPECODES[sample_format])
+    values.frombytes(raw)
+    if sys.byteorder == 'big' and values.itemsize > 1:
+        values.byteswap()
+
+    if channels == 1:
+        mixed = values
+    elif sample_format.startswith("float"):
+        mixed = [sum(frame) / channels for frame in zip(*[values[c::channels] for c in range(channels)])]
+    else:
+        mixed = [sum(frame) // channels for frame in zip(*[values[c::channels] for c in range(channels)])]
+
+    if sample_format == "int16":
+        return array('h', mixed)
+    elif sample_format == "int8":
+        return array('h', [(v - 128) << 8 for v in mixed])
+    elif sample_format == "int32":
+        return array('h', [v >> 16 for v in mixed])
+    return array('h', [max(-32768, min(32767, round(v * 32767))) for v in mixed])
+
+def wav_header(num_samples, sample_rate):
+    data_size = num_samples * 2
+    return struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + data_size, b"WAVE",
+                       b"fmt ", 16, WAVE_FORMAT_PCM, 1, sample_rate, sample_rate * 2, 2, 16,
+                       b"data", data_size)
+
+def pcm16_bytes(samples):
+    if np is not None and isinstance(samples, np.ndarray):
+        return samples.astype('<i2').tobytes()
+
+    if not isinstance(samples, array) or samples.typecode != 'h':
+        samples = array('h', samples)
+    if sys.byteorder == 'big':
+        samples = array('h', samples)
+        samples.byteswap()
+    return samples
 
 def write_wav(filename, samples, sample_rate):
-    with wave.open(filename, 'wb') as wav:
-        wav.setnchannels(1)
-        wav.setsampwidth(2)
-        wav.setframerate(sample_rate)
+    with open(filename, 'wb') as wav:
+        wav.write(wav_header(len(samples), sample_rate))
+
+        for start in range(0, len(samples), WAV_CHUNK_FRAMES):
+            wav.write(pcm16_bytes(samples[start:start + WAV_CHUNK_FRAMES]))
 
-        wav_data = b''
-        for sample in samples:
-            wav_data += struct.pack('<h', sample)
+def write_wav_stream(filename, chunks, num_samples, sample_rate):
+    with open(filename, 'wb') as wav:
+        wav.write(wav_header(num_samples, sample_rate))
 
-        wav.writeframes(wav_data)
+        for chunk in chunks:
+            wav.write(pcm16_bytes(chunk))
 
-def resample_audio(samples, original_rate, target_rate):
+def resample_audio(samples, original_rate, target_rate, mode="linear"):
     if original_rate == target_rate:
         return samples
 
-    ratio = target_rate / original_rate
-    new_length = int(len(samples) * ratio)
-
-    resampled = []
-    for i in range(new_length):
-        src_pos = i / ratio
-        src_index = int(src_pos)
-        frac = src_pos - src_index
-
-        if src_index + 1 < len(samples):
-            sample = int(samples[src_index] * (1 - frac) + samples[src_index + 1] * frac)
-        else:
-            sample = samples[src_index]
-
-        resampled.append(sample)
-
+    resampled = array('h')
+    for block in resample_stream([samples], original_rate, target_rate, mode):
+        resampled.extend(block)
     return resampled
 
-def find_pattern_in_file(file_path, pattern):
-    with open(file_path, 'rb') as f:
-        data = f.read()
-        offset = data.find(pattern)
-        return offset if offset != -1 else None
-
-def replace_bytes_in_file(file_path, offset, new_data):
-    with open(file_path, 'r+b') as f:
-        f.seek(offset)
-        f.write(new_data)
+def encode_wav_to_adpcm(wav_path, target_rate, coefficients, resample_mode=DEFAULT_RESAMPLE_MODE,
+                        profiler=NULL_PROFILER):
+    with open(wav_path, 'rb') as wav_file:
+        wav_sample_rate = read_wav_info(wav_file)['sample_rate']
+
+    # Blocks are resampled as they are read, so only the output is ever held in full
+    blocks = profiler.timed("wav_read", iter_wav_samples(wav_path), _block_bytes)
+    if wav_sample_rate != target_rate:
+        blocks = profiler.timed("resample", resample_stream(blocks, wav_sample_rate, target_rate, resample_mode),
+                                _block_bytes)
+
+    samples = array('h')
+    for block in blocks:
+        samples.extend(block)
+
+    with profiler.stage("encode", len(samples) * 2):
+        adpcm_data = encode_dsp_adpcm(samples, coefficients)
+    return len(samples), wav_sample_rate, adpcm_data
+
+def encode_wav_to_adpcm_profiled(wav_path, target_rate, coefficients, resample_mode, index, trace_memory):
+    # Pool entry point: the records travel back with the result
+    profiler = Profiler("rebuild", trace_memory).start()
+    with profiler.sound(index):
+        result = encode_wav_to_adpcm(wav_path, target_rate, coefficients, resample_mode, profiler)
+    profiler.stop()
+    return result, profiler.records
+
+def _block_bytes(block):
+    return len(block) * 2
+
+def apply_patches(file_patches):
+    # Every file's patches are checked before anything is written, and every
+    # patched copy is on disk before any original is replaced, so a bad patch
+    # or a crash while writing leaves the whole UBER/SAMP pair as it was.
+    checked = [(file_path, _check_patches(file_path, patches)) for file_path, patches in file_patches.items()]
+
+    temp_paths = []
+    try:
+        for file_path, patches in checked:
+            temp_paths.append(_write_patched_copy(file_path, patches))
+        for (file_path, _), temp_path in zip(checked, temp_paths):
+            os.replace(temp_path, file_path)
+    except BaseException:
+        for temp_path in temp_paths:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        raise
+
+    for directory in {os.path.dirname(os.path.abspath(file_path)) for file_path, _ in checked}:
+        _fsync_directory(directory)
+
+def _check_patches(file_path, patches):
+    # Sounds that alias the same bytes produce identical patches at the same
+    # offset; those are written once. Anything else overlapping is an error.
+    patches = sorted(set(patches), key=lambda patch: patch[0])
+    file_size = os.path.getsize(file_path)
+
+    end = 0
+    for offset, new_data in patches:
+        if offset < end:
+            raise ValueError(f"Overlapping patches at offset 0x{offset:X} in {os.path.basename(file_path)}")
+        end = offset + len(new_data)
+        if end > file_size:
+            raise ValueError(f"Patch at offset 0x{offset:X} runs past the end of {os.path.basename(file_path)}")
+    return patches
+
+def _write_patched_copy(file_path, patches):
+    # The patched file is written next to the original under a temporary name
+    directory = os.path.dirname(os.path.abspath(file_path))
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(file_path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with open(file_path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            position = 0
+            for offset, new_data in patches:
+                _copy_bytes(src, dst, offset - position)
+                dst.write(new_data)
+                src.seek(len(new_data), os.SEEK_CUR)
+                position = offset + len(new_data)
+            shutil.copyfileobj(src, dst, PATCH_COPY_BUFFER)
+
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        shutil.copymode(file_path, temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return temp_path
+
+def _copy_bytes(src, dst, length):
+    while length > 0:
+        chunk = src.read(min(length, PATCH_COPY_BUFFER))
+        if not chunk:
+            break
+        dst.write(chunk)
+        length -= len(chunk)
+
+def _fsync_directory(directory):
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class PatchPlan:
+    def __init__(self):
+        self.patches = {}
+
+    def add(self, file_path, offset, new_data):
+        self.patches.setdefault(file_path, []).append((offset, bytes(new_data)))
+
+    def count(self, file_path):
+        return len(self.patches.get(file_path, []))
+
+    def find_unclaimed(self, file_path, pattern):
+        # Pattern search for containers without an SDIR index. Regions that
+        # are already planned are skipped so duplicate payloads map to
+        # distinct locations, as they did when each patch was written at once.
+        claimed = self.patches.get(file_path, [])
+        data = map_file(file_path)
+        try:
+            start = 0
+            while True:
+                offset = data.obj.find(pattern, start)
+                if offset == -1:
+                    return None
+                end = offset + len(pattern)
+                if not any(offset < o + len(d) and o < end for o, d in claimed):
+                    return offset
+                start = offset + 1
+        finally:
+            data.release()
+
+    def commit(self):
+        apply_patches(self.patches)
+        self.patches = {}
@@ -0,0 +1,231 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+
+class _Frame:
+    __slots__ = ('start', 'child_seconds', 'peak')
+
+    def __init__(self, start):
+        self.start = start
+        self.child_seconds = 0.0
+        self.peak = 0
+
+class _Stage:
+    def __init__(self, profiler, name, nbytes, sound):
+        self.profiler = profiler
+        self.name = name
+        self.bytes = nbytes
+        self.sound = sound
+
+    def __enter__(self):
+        self.frame = self.profiler._enter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds, peak = self.profiler._exit(self.frame)
+        self.profiler.add(self.name, seconds, self.bytes, peak, self.sound)
+
+class _Sound:
+    def __init__(self, profiler, index):
+        self.profiler = profiler
+        self.index = index
+
+    def __enter__(self):
+        self.previous = getattr(self.profiler.local, 'sound', None)
+        self.profiler.local.sound = self.index
+
+    def __exit__(self, exc_type, exc, tb):
+        self.profiler.local.sound = self.previous
+
+class Profiler:
+    # Records wall time, bytes and (optionally) tracemalloc peak per stage.
+    # Times are exclusive: a stage nested inside another is not counted
+    # twice, so the stage totals add up to the operation's wall time.
+    # Records merged from pool workers are the exception; they overlap.
+    def __init__(self, operation=None, trace_memory=False, enabled=True):
+        self.operation = operation
+        self.trace_memory = trace_memory
+        self.enabled = enabled
+        self.records = []
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = None
+        self.seconds = None
+        self.owns_tracing = False
+
+    def start(self):
+        if self.enabled and self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.owns_tracing = True
+        self.started = time.perf_counter()
+        return self
+
+    def stop(self):
+        if self.started is not None:
+            self.seconds = time.perf_counter() - self.started
+        if self.owns_tracing:
+            tracemalloc.stop()
+            self.owns_tracing = False
+        return self
+
+    def stage(self, name, nbytes=0, sound=None):
+        if not self.enabled:
+            return _NO_STAGE
+        return _Stage(self, name, nbytes, sound)
+
+    def sound(self, index):
+        # Stages started inside this block are attributed to the sound
+        if not self.enabled:
+            return _NO_STAGE
+        return _Sound(self, index)
+
+    def timed(self, name, iterable, measure=None):
+        # Times only the work done producing each item, not the consumer's
+        if not self.enabled:
+            yield from iterable
+            return
+
+        iterator = iter(iterable)
+        seconds = 0.0
+        nbytes = 0
+        peak = None
+        try:
+            while True:
+                frame = self._enter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed, frame_peak = self._exit(frame)
+                    seconds += elapsed
+                    if frame_peak is not None:
+                        peak = max(peak or 0, frame_peak)
+                if measure is not None:
+                    nbytes += measure(item)
+                yield item
+        finally:
+            self.add(name, seconds, nbytes, peak)
+
+    def add(self, name, seconds, nbytes=0, peak=None, sound=None):
+        record = {
+            'stage': name,
+            'sound': sound if sound is not None else getattr(self.local, 'sound', None),
+            'seconds': seconds,
+            'bytes': nbytes,
+            'peak_bytes': peak
+        }
+        with self.lock:
+            self.records.append(record)
+
+    def merge(self, records):
+        # Records measured in a worker process
+        with self.lock:
+            for record in records:
+                record['worker'] = True
+                self.records.append(record)
+
+    def _stack(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _enter(self):
+        stack = self._stack()
+        if self.trace_memory and tracemalloc.is_tracing():
+            # The enclosing stage keeps the peak seen so far before the
+            # counter is reset for this one.
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        frame = _Frame(time.perf_counter())
+        stack.append(frame)
+        return frame
+
+    def _exit(self, frame):
+        elapsed = time.perf_counter() - frame.start
+        stack = self._stack()
+        stack.pop()
+
+        peak = None
+        if self.trace_memory and tracemalloc.is_tracing():
+            peak = max(frame.peak, tracemalloc.get_traced_memory()[1])
+        if stack:
+            stack[-1].child_seconds += elapsed
+            if peak is not None:
+                stack[-1].peak = max(stack[-1].peak, peak)
+        return elapsed - frame.child_seconds, peak
+
+    def totals(self):
+        totals = OrderedDict()
+        with self.lock:
+            records = list(self.records)
+        for record in records:
+            total = totals.setdefault(record['stage'], {'count': 0, 'seconds': 0.0, 'bytes': 0,
+                                                        'peak_bytes': None})
+            total['count'] += 1
+            total['seconds'] += record['seconds']
+            total['bytes'] += record['bytes']
+            if record['peak_bytes'] is not None:
+                total['peak_bytes'] = max(total['peak_bytes'] or 0, record['peak_bytes'])
+        return totals
+
+    def summary(self):
+        lines = [f"Timing for {self.operation}: {self.seconds or 0:.2f}s"]
+        for name, total in self.totals().items():
+            line = f"  {name:<14} {total['seconds']:8.3f}s  x{total['count']:<5}"
+            if total['bytes']:
+                line += f" {format_bytes(total['bytes']):>10}"
+                if total['seconds'] > 0:
+                    line += f" {format_bytes(total['bytes'] / total['seconds'])}/s"
+            if total['peak_bytes'] is not None:
+                line += f"  peak {format_bytes(total['peak_bytes'])}"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def report(self):
+        with self.lock:
+            records = list(self.records)
+        return {
+            'operation': self.operation,
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'seconds': self.seconds,
+            'trace_memory': self.trace_memory,
+            'stages': self.totals(),
+            'records': records
+        }
+
+    def write_report(self, directory, name):
+        os.makedirs(directory, exist_ok=True)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        path = os.path.join(directory, f"{name}-{self.operation}-{stamp}.json")
+        suffix = 1
+        while os.path.exists(path):
+            path = os.path.join(directory, f"{name}-{self.operation}-{stamp}-{suffix}.json")
+            suffix += 1
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        return path
+
+class _NoStage:
+    bytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+_NO_STAGE = _NoStage()
+NULL_PROFILER = Profiler(enabled=False)
+
+def format_bytes(size):
+    for unit in ("B", "KB", "MB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GB"
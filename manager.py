@@ -1,18 +1,59 @@
 import tkinter as tk
 from tkinter import filedialog, scrolledtext, messagebox, ttk
+import argparse
+import operator
 import os
+import queue
+import re
 import subprocess
 import platform
-from pathlib import Path
+import threading
+import traceback
 
-from dsp_codec import decode_dsp_adpcm, encode_dsp_adpcm, create_dsp_file, nibbles_to_samples
-from file_operations import (
-    extract_sdir_from_uber, load_sound_data, read_wav_file,
-    write_wav, resample_audio, find_pattern_in_file, replace_bytes_in_file
+from sound_operations import (
+    load_bank, extract_wavs, extract_dsps, find_rebuild_sources, plan_rebuild, finish_rebuild,
+    OperationCancelled, DEFAULT_WRITE_THREADS
 )
+from pcm_cache import PCMCache, DiskPCMCache, DEFAULT_PCM_CACHE_BYTES, DEFAULT_DISK_CACHE_BYTES
+from preview_cache import PreviewCache, DEFAULT_PREVIEW_CACHE_BYTES
+from instrumentation import Profiler, NULL_PROFILER
+from rebuild_manifest import RebuildManifest, manifest_path
+from resampler import DEFAULT_RESAMPLE_MODE
+from status_log import StatusLog, DEFAULT_STATUS_LINES
+
+EVENT_POLL_MS = 50
+EVENT_BATCH = 500
+SOUND_LIST_CHUNK = 500
+CHECKED = "\u2611"
+UNCHECKED = "\u2610"
+
+FILTER_FIELDS = {'index': 'index', 'rate': 'sample_rate', 'duration': 'duration', 'dur': 'duration'}
+FILTER_OPERATORS = {'<': operator.lt, '<=': operator.le, '=': operator.eq, '>=': operator.ge, '>': operator.gt}
+FILTER_PATTERN = re.compile(r"\b(index|rate|duration|dur)\s*(<=|>=|=|<|>)\s*(\d+(?:\.\d+)?)", re.IGNORECASE)
+
+def parse_sound_filter(text):
+    # "rate=32000 dur>1.5 gigan" -> field comparisons plus words the name must contain
+    conditions = []
+
+    def take(match):
+        conditions.append((FILTER_FIELDS[match.group(1).lower()], FILTER_OPERATORS[match.group(2)],
+                           float(match.group(3))))
+        return " "
+
+    words = FILTER_PATTERN.sub(take, text).lower().split()
+    return conditions, words
+
+def sound_matches(sound_info, name, conditions, words):
+    for field, compare, value in conditions:
+        if not compare(getattr(sound_info, field), value):
+            return False
+    return all(word in name for word in words)
 
 class AudioExtractor:
-    def __init__(self, root):
+    def __init__(self, root, pcm_cache_bytes=DEFAULT_PCM_CACHE_BYTES, rebuild_workers=None,
+                 disk_cache_bytes=DEFAULT_DISK_CACHE_BYTES, preview_cache_bytes=DEFAULT_PREVIEW_CACHE_BYTES,
+                 resample_mode=DEFAULT_RESAMPLE_MODE, profile_dir=None, trace_memory=False,
+                 log_file=None, status_lines=DEFAULT_STATUS_LINES, extract_writers=DEFAULT_WRITE_THREADS):
         self.root = root
         self.root.title("Unleashed Sound Manager - Extractor & Rebuilder")
         self.root.geometry("900x700")
@@ -21,10 +62,29 @@ class AudioExtractor:
         self.samp_file = None
         self.extracted_sounds = []
         self.loaded_sounds = []
-        self.sound_checkboxes = []
-        self.sdir_temp_path = None
+        self.rebuild_index = None
+        self.sound_selection = bytearray()
+        self.shown_positions = []
+        self.sort_key = 'index'
+        self.sort_reverse = False
+        self.list_generation = 0
+        self.pcm_cache = PCMCache(pcm_cache_bytes, self.open_disk_cache(disk_cache_bytes))
+        self.preview_cache = PreviewCache(self.pcm_cache, preview_cache_bytes)
+        self.rebuild_workers = rebuild_workers or os.cpu_count() or 1
+        self.extract_writers = extract_writers
+        self.resample_mode = resample_mode
+        self.profile_dir = profile_dir
+        self.trace_memory = trace_memory
+        self.load_profiler = NULL_PROFILER
+        self.events = queue.Queue()
+        self.worker = None
+        self.cancel_event = threading.Event()
+        self.log_file = log_file
+        self.status_lines = status_lines
 
         self.create_widgets()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(EVENT_POLL_MS, self.poll_events)
 
     def create_widgets(self):
         frame = tk.Frame(self.root, padx=20, pady=20)
@@ -41,8 +101,8 @@ class AudioExtractor:
         self.uber_entry.insert(0, "No .UBER file selected (drag & drop or browse)")
         self.uber_entry.config(state='readonly')
 
-        uber_btn = tk.Button(uber_frame, text="Browse UBER...", command=self.browse_uber, width=15)
-        uber_btn.pack(side=tk.RIGHT)
+        self.uber_btn = tk.Button(uber_frame, text="Browse UBER...", command=self.browse_uber, width=15)
+        self.uber_btn.pack(side=tk.RIGHT)
 
         samp_frame = tk.Frame(file_input_frame)
         samp_frame.pack(fill=tk.X, pady=5)
@@ -52,8 +112,8 @@ class AudioExtractor:
         self.samp_entry.insert(0, "No .SAMP file selected (drag & drop or browse)")
         self.samp_entry.config(state='readonly')
 
-        samp_btn = tk.Button(samp_frame, text="Browse SAMP...", command=self.browse_samp, width=15)
-        samp_btn.pack(side=tk.RIGHT)
+        self.samp_btn = tk.Button(samp_frame, text="Browse SAMP...", command=self.browse_samp, width=15)
+        self.samp_btn.pack(side=tk.RIGHT)
 
         try:
             file_input_frame.drop_target_register('DND_Files')
@@ -88,6 +148,10 @@ class AudioExtractor:
                                       width=15, height=2, bg="#6c757d", fg="white")
         self.rebuild_btn.pack(side=tk.LEFT, padx=10)
 
+        self.cancel_btn = tk.Button(button_frame, text="Cancel", command=self.cancel_operation,
+                                     width=15, height=2, state=tk.DISABLED)
+        self.cancel_btn.pack(side=tk.LEFT, padx=10)
+
         progress_frame = tk.Frame(frame)
         progress_frame.pack(fill=tk.X, pady=(0, 10))
 
@@ -105,26 +169,40 @@ class AudioExtractor:
         sounds_label = tk.Label(left_frame, text="Loaded Sounds:", anchor='w')
         sounds_label.pack(fill=tk.X, pady=(0, 5))
 
-        sounds_frame = tk.Frame(left_frame, relief=tk.SUNKEN, bd=2)
-        sounds_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
+        filter_frame = tk.Frame(left_frame)
+        filter_frame.pack(fill=tk.X, pady=(0, 5))
 
-        self.sounds_canvas = tk.Canvas(sounds_frame, height=200)
-        sounds_scrollbar = tk.Scrollbar(sounds_frame, orient="vertical", command=self.sounds_canvas.yview)
-        self.sounds_scrollable_frame = tk.Frame(self.sounds_canvas)
-
-        self.sounds_scrollable_frame.bind(
-            "<Configure>",
-            lambda e: self.sounds_canvas.configure(scrollregion=self.sounds_canvas.bbox("all"))
-        )
+        filter_label = tk.Label(filter_frame, text="Filter:")
+        filter_label.pack(side=tk.LEFT)
 
-        self.sounds_canvas.create_window((0, 0), window=self.sounds_scrollable_frame, anchor="nw")
-        self.sounds_canvas.configure(yscrollcommand=sounds_scrollbar.set)
+        self.filter_var = tk.StringVar()
+        self.filter_var.trace_add('write', lambda *args: self.refresh_sound_list())
+        filter_entry = tk.Entry(filter_frame, textvariable=self.filter_var)
+        filter_entry.pack(side=tk.LEFT, fill=tk.X, expand=True, padx=(5, 0))
 
-        self.sounds_canvas.bind_all("<MouseWheel>", self._on_mousewheel)
-        self.sounds_canvas.bind_all("<Button-4>", self._on_mousewheel)
-        self.sounds_canvas.bind_all("<Button-5>", self._on_mousewheel)
+        sounds_frame = tk.Frame(left_frame, relief=tk.SUNKEN, bd=2)
+        sounds_frame.pack(fill=tk.BOTH, expand=True, pady=(0, 10))
 
-        self.sounds_canvas.pack(side="left", fill="both", expand=True)
+        self.sound_tree = ttk.Treeview(sounds_frame, columns=('selected', 'name', 'rate', 'duration'),
+                                       show='headings', selectmode='browse', height=10)
+        self.sound_tree.heading('selected', text=CHECKED)
+        self.sound_tree.heading('name', text="Sound", command=lambda: self.sort_sound_list('index'))
+        self.sound_tree.heading('rate', text="Sample Rate", command=lambda: self.sort_sound_list('sample_rate'))
+        self.sound_tree.heading('duration', text="Length", command=lambda: self.sort_sound_list('duration'))
+        self.sound_tree.column('selected', width=30, stretch=False, anchor='center')
+        self.sound_tree.column('name', width=140)
+        self.sound_tree.column('rate', width=90, anchor='e')
+        self.sound_tree.column('duration', width=70, anchor='e')
+
+        sounds_scrollbar = ttk.Scrollbar(sounds_frame, orient="vertical", command=self.sound_tree.yview)
+        self.sound_tree.configure(yscrollcommand=sounds_scrollbar.set)
+
+        self.sound_tree.bind('<Button-1>', self.on_sound_tree_click)
+        self.sound_tree.bind('<Double-1>', self.on_sound_tree_double_click)
+        self.sound_tree.bind('<space>', lambda e: self.toggle_focused_sound())
+        self.sound_tree.bind('<Return>', lambda e: self.preview_focused_sound())
+
+        self.sound_tree.pack(side="left", fill="both", expand=True)
         sounds_scrollbar.pack(side="right", fill="y")
 
         selection_btn_frame = tk.Frame(left_frame)
@@ -138,6 +216,10 @@ class AudioExtractor:
                                     command=self.select_none_sounds, width=12)
         select_none_btn.pack(side=tk.LEFT, padx=5)
 
+        preview_btn = tk.Button(selection_btn_frame, text="Preview",
+                                command=self.preview_focused_sound, width=12)
+        preview_btn.pack(side=tk.LEFT, padx=5)
+
         right_frame = tk.Frame(content_frame)
         right_frame.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
 
@@ -150,10 +232,22 @@ class AudioExtractor:
         self.status_text = scrolledtext.ScrolledText(status_frame, wrap=tk.WORD, height=20,
                                                       relief=tk.FLAT, bd=0)
         self.status_text.pack(fill=tk.BOTH, expand=True)
+        self.status_log = StatusLog(self.root, self.status_text, self.status_lines, mirror_path=self.log_file)
 
         self.update_status()
 
+    def open_disk_cache(self, max_bytes):
+        if not max_bytes:
+            return None
+        try:
+            return DiskPCMCache(max_bytes=max_bytes)
+        except OSError:
+            return None
+
     def on_drop_combined(self, event):
+        if self.worker is not None:
+            return
+
         files = self.parse_drop_files(event.data)
         if not files:
             return
@@ -229,89 +323,241 @@ class AudioExtractor:
             self.update_status()
 
     def update_status(self):
-        self.status_text.delete(1.0, tk.END)
+        self.status_log.clear()
         if not self.uber_file and not self.samp_file:
-            self.status_text.insert(tk.END, "Please Browse for .UBER & .SAMP files.")
+            self.status_log.write("Please Browse for .UBER & .SAMP files.")
         elif self.uber_file and not self.samp_file:
-            self.status_text.insert(tk.END, "Please Browse for .SAMP file")
+            self.status_log.write("Please Browse for .SAMP file")
         elif not self.uber_file and self.samp_file:
-            self.status_text.insert(tk.END, "Please Browse for .UBER file")
+            self.status_log.write("Please Browse for .UBER file")
         else:
-            self.status_text.insert(tk.END, "Files loaded. Auto-loading sound data...")
-            self.root.update()
+            self.status_log.write("Files loaded. Auto-loading sound data...")
             self.auto_load()
 
-    def _on_mousewheel(self, event):
-        if event.num == 5 or event.delta < 0:
-            self.sounds_canvas.yview_scroll(1, "units")
-        elif event.num == 4 or event.delta > 0:
-            self.sounds_canvas.yview_scroll(-1, "units")
-
     def select_all_sounds(self):
-        for var in self.sound_checkboxes:
-            var.set(True)
+        self.set_shown_selection(1)
 
     def select_none_sounds(self):
-        for var in self.sound_checkboxes:
-            var.set(False)
+        self.set_shown_selection(0)
+
+    def set_shown_selection(self, value):
+        # Only the rows that pass the current filter are affected
+        for pos in self.shown_positions:
+            self.sound_selection[pos] = value
+        mark = CHECKED if value else UNCHECKED
+        for iid in self.sound_tree.get_children():
+            self.sound_tree.set(iid, 'selected', mark)
+
+    def toggle_sound(self, pos):
+        self.sound_selection[pos] ^= 1
+        self.sound_tree.set(str(pos), 'selected', CHECKED if self.sound_selection[pos] else UNCHECKED)
+
+    def toggle_focused_sound(self):
+        focused = self.sound_tree.focus()
+        if focused:
+            self.toggle_sound(int(focused))
+
+    def on_sound_tree_click(self, event):
+        if self.sound_tree.identify_region(event.x, event.y) != 'cell':
+            return
+        row = self.sound_tree.identify_row(event.y)
+        if row and self.sound_tree.identify_column(event.x) == '#1':
+            self.toggle_sound(int(row))
 
-    def auto_load(self):
-        try:
-            self.sdir_temp_path = extract_sdir_from_uber(self.uber_file, silent=True)
+    def on_sound_tree_double_click(self, event):
+        if self.sound_tree.identify_region(event.x, event.y) != 'cell':
+            return
+        row = self.sound_tree.identify_row(event.y)
+        if not row:
+            return
+        if self.sound_tree.identify_column(event.x) == '#1':
+            self.toggle_sound(int(row))
+        else:
+            self.preview_loaded_sound(self.loaded_sounds[int(row)])
 
-            if not self.sdir_temp_path or not os.path.exists(self.sdir_temp_path):
-                self.status_text.insert(tk.END, "\nERROR: Could not extract SDIR file")
-                return
+    def sort_sound_list(self, key):
+        if self.sort_key == key:
+            self.sort_reverse = not self.sort_reverse
+        else:
+            self.sort_key = key
+            self.sort_reverse = False
+        self.refresh_sound_list()
+
+    def run_in_background(self, work, on_done, on_error, on_cancel=None):
+        # Work without a cancel handler never checks for one, so Cancel stays off
+        self.cancel_event.clear()
+        self.set_busy(True, on_cancel is not None)
+        self.worker = threading.Thread(target=self.worker_main,
+                                       args=(work, on_done, on_error, on_cancel), daemon=True)
+        self.worker.start()
+
+    def worker_main(self, work, on_done, on_error, on_cancel):
+        # Runs off the Tk thread: widgets are only touched from poll_events
+        try:
+            result = work()
+        except OperationCancelled:
+            self.events.put(('finished', on_cancel, ()))
+        except Exception as e:
+            self.events.put(('finished', on_error, (e, traceback.format_exc())))
+        else:
+            self.events.put(('finished', on_done, (result,)))
 
-            self.loaded_sounds = load_sound_data(self.sdir_temp_path, self.samp_file)
-            self.populate_sound_list()
+    def poll_events(self):
+        try:
+            for _ in range(EVENT_BATCH):
+                event = self.events.get_nowait()
+                if event[0] == 'progress':
+                    _, verb, done, total = event
+                    self.progress_bar['value'] = done
+                    self.progress_label['text'] = f"{verb} {done}/{total}"
+                elif event[0] == 'finished':
+                    _, callback, args = event
+                    self.worker = None
+                    self.set_busy(False)
+                    if callback is not None:
+                        callback(*args)
+        except queue.Empty:
+            pass
+        finally:
+            self.root.after(EVENT_POLL_MS, self.poll_events)
+
+    def set_busy(self, busy, cancellable=True):
+        state = tk.DISABLED if busy else tk.NORMAL
+        for button in (self.extract_wav_btn, self.extract_dsp_btn, self.rebuild_btn, self.uber_btn, self.samp_btn):
+            button.config(state=state)
+        self.cancel_btn.config(state=tk.NORMAL if busy and cancellable else tk.DISABLED)
+
+    def cancel_operation(self):
+        if self.worker is not None and not self.cancel_event.is_set():
+            self.cancel_event.set()
+            self.progress_label['text'] = "Cancelling..."
+
+    def log_status(self, text):
+        # Safe to call from the worker; the sink batches it onto the widget
+        self.status_log.write(text)
+
+    def progress_callback(self, verb):
+        def report(done, total):
+            self.events.put(('progress', verb, done, total))
+            # Checked after each finished sound so a cancel never leaves one half-written
+            if self.cancel_event.is_set():
+                raise OperationCancelled()
+        return report
+
+    def reset_progress(self):
+        self.progress_bar['value'] = 0
+        self.progress_label['text'] = ""
 
-            if self.sdir_temp_path and os.path.exists(self.sdir_temp_path):
-                os.remove(self.sdir_temp_path)
-                self.sdir_temp_path = None
+    def start_profiler(self, operation):
+        if self.profile_dir is None:
+            return NULL_PROFILER
+        return Profiler(operation, self.trace_memory).start()
 
-            self.status_text.insert(tk.END, f"\nLoaded {len(self.loaded_sounds)} sound(s).\n")
-            self.status_text.insert(tk.END, "Select sounds and click Extract (WAV) or Extract (DSP).")
+    def finish_profiler(self, profiler, write_report=True):
+        if not profiler.enabled:
+            return
+        profiler.stop()
+        if not write_report:
+            return
 
+        self.status_log.write(f"\n\n{profiler.summary()}")
+        try:
+            report_path = profiler.write_report(self.profile_dir, self.sound_list_base_name())
+            self.status_log.write(f"\nTiming report saved to {report_path}")
         except Exception as e:
-            self.status_text.insert(tk.END, f"\nERROR during auto-load: {str(e)}")
-            if self.sdir_temp_path and os.path.exists(self.sdir_temp_path):
-                os.remove(self.sdir_temp_path)
-                self.sdir_temp_path = None
+            self.status_log.write(f"\nCould not save timing report: {str(e)}")
 
-    def populate_sound_list(self):
-        for widget in self.sounds_scrollable_frame.winfo_children():
-            widget.destroy()
+    def auto_load(self):
+        self.preview_cache.clear()
+        self.pcm_cache.clear()
+        uber_file, samp_file = self.uber_file, self.samp_file
+        profiler = self.load_profiler = self.start_profiler("load")
+        self.run_in_background(lambda: load_bank(uber_file, samp_file, profiler),
+                               self.on_sounds_loaded, self.on_load_error)
+
+    def on_sounds_loaded(self, result):
+        self.loaded_sounds, self.rebuild_index = result
+        self.populate_sound_list()
+        self.reset_progress()
+
+        self.status_log.write(f"\nLoaded {len(self.loaded_sounds)} sound(s).\n")
+        self.status_log.write("Select sounds and click Extract (WAV) or Extract (DSP).")
+        self.finish_profiler(self.load_profiler)
+
+    def on_load_error(self, e, details):
+        self.reset_progress()
+        self.status_log.write(f"\nERROR during auto-load: {str(e)}")
+        self.finish_profiler(self.load_profiler, write_report=False)
+
+    def on_close(self):
+        self.cancel_event.set()
+        self.preview_cache.close()
+        self.status_log.close()
+        self.root.destroy()
+
+    def release_loaded_sounds(self):
+        # Entries hold views into the mapped SAMP; drop them all so the file
+        # can be replaced on platforms that lock mapped files.
+        self.loaded_sounds = []
+        self.extracted_sounds = []
+        self.rebuild_index = None
+        writers = self.preview_cache.clear()
+        self.pcm_cache.clear()
+        self.populate_sound_list()
+        return writers
 
-        self.sound_checkboxes = []
+    def populate_sound_list(self):
+        self.sound_selection = bytearray(b'\x01') * len(self.loaded_sounds)
+        self.refresh_sound_list()
 
-        base_filename = os.path.splitext(os.path.basename(self.uber_file))[0] if self.uber_file else "sound"
+    def sound_list_base_name(self):
+        return os.path.splitext(os.path.basename(self.uber_file))[0] if self.uber_file else "sound"
 
-        for sound_info in self.loaded_sounds:
-            var = tk.BooleanVar(value=True)
-            self.sound_checkboxes.append(var)
+    def refresh_sound_list(self):
+        # Rows are (re)inserted a chunk at a time from the event loop, so a
+        # new sort or filter simply abandons the previous generation.
+        self.list_generation += 1
+        self.sound_tree.delete(*self.sound_tree.get_children())
 
-            sound_frame = tk.Frame(self.sounds_scrollable_frame)
-            sound_frame.pack(fill=tk.X, padx=5, pady=2)
+        conditions, words = parse_sound_filter(self.filter_var.get())
+        base_filename = self.sound_list_base_name().lower()
+        positions = [pos for pos, sound_info in enumerate(self.loaded_sounds)
+                     if sound_matches(sound_info, f"{base_filename}_{sound_info.index:02d}", conditions, words)]
+        positions.sort(key=lambda pos: (getattr(self.loaded_sounds[pos], self.sort_key), pos), reverse=self.sort_reverse)
+        self.shown_positions = positions
 
-            cb = tk.Checkbutton(sound_frame, variable=var, text=f"{base_filename}_{sound_info['index']:02d}")
-            cb.pack(side=tk.LEFT)
+        self.insert_sound_rows(self.list_generation, 0)
 
-            info_label = tk.Label(sound_frame,
-                                 text=f"- {sound_info['sample_rate']} Hz, {sound_info['duration']:.2f}s")
-            info_label.pack(side=tk.LEFT)
+    def insert_sound_rows(self, generation, start):
+        if generation != self.list_generation:
+            return
 
-            preview_btn = tk.Button(sound_frame, text="Preview",
-                                   command=lambda s=sound_info: self.preview_loaded_sound(s))
-            preview_btn.pack(side=tk.LEFT, padx=5)
+        base_filename = self.sound_list_base_name()
+        end = start + SOUND_LIST_CHUNK
+        for pos in self.shown_positions[start:end]:
+            sound_info = self.loaded_sounds[pos]
+            self.sound_tree.insert('', tk.END, iid=str(pos), values=(
+                CHECKED if self.sound_selection[pos] else UNCHECKED,
+                f"{base_filename}_{sound_info.index:02d}",
+                f"{sound_info.sample_rate} Hz",
+                f"{sound_info.duration:.2f}s"
+            ))
+
+        if end < len(self.shown_positions):
+            self.root.after(1, self.insert_sound_rows, generation, end)
+
+    def preview_focused_sound(self):
+        focused = self.sound_tree.focus()
+        if focused:
+            self.preview_loaded_sound(self.loaded_sounds[int(focused)])
 
     def preview_loaded_sound(self, sound_info):
-        import tempfile
-        temp_wav = tempfile.NamedTemporaryFile(delete=False, suffix='.wav')
-        temp_wav.close()
-
-        write_wav(temp_wav.name, sound_info['pcm_samples'], sound_info['sample_rate'])
-        self.preview_sound(temp_wav.name)
+        try:
+            wav_path = self.preview_cache.get(sound_info)
+        except Exception as e:
+            messagebox.showerror("Error", f"Could not preview sound: {str(e)}")
+            return
+        self.preview_sound(wav_path)
 
     def preview_sound(self, wav_path):
         if not os.path.exists(wav_path):
@@ -329,113 +575,82 @@ class AudioExtractor:
         except Exception as e:
             messagebox.showerror("Error", f"Could not preview sound: {str(e)}")
 
+    def selected_sounds(self):
+        return [sound_info for sound_info, selected in zip(self.loaded_sounds, self.sound_selection) if selected]
+
     def extract(self):
         if not self.loaded_sounds:
             messagebox.showwarning("No Sounds Loaded", "Please load UBER and SAMP files first")
             return
 
-        selected_indices = [i for i, var in enumerate(self.sound_checkboxes) if var.get()]
+        selected_sounds = self.selected_sounds()
 
-        if not selected_indices:
+        if not selected_sounds:
             messagebox.showwarning("No Sounds Selected", "Please select at least one sound to extract")
             return
 
-        self.status_text.insert(tk.END, f"\nExtracting {len(selected_indices)} selected sound(s)...\n")
+        self.status_log.write(f"\nExtracting {len(selected_sounds)} selected sound(s)...\n")
         self.progress_bar['value'] = 0
-        self.progress_bar['maximum'] = len(selected_indices)
-        self.root.update()
-
-        try:
-            base_name = os.path.splitext(self.uber_file)[0]
-            self.extracted_sounds = []
+        self.progress_bar['maximum'] = len(selected_sounds)
 
-            for progress_idx, idx in enumerate(selected_indices):
-                sound_info = self.loaded_sounds[idx]
-                wav_path = f"{base_name}_{sound_info['index']:02d}.wav"
-                dsp_path = f"{base_name}_{sound_info['index']:02d}.dsp"
-
-                write_wav(wav_path, sound_info['pcm_samples'], sound_info['sample_rate'])
-
-                extracted_info = {
-                    'index': sound_info['index'],
-                    'path': wav_path,
-                    'dsp_path': dsp_path,
-                    'dsp_data': sound_info['dsp_data'],
-                    'sample_rate': sound_info['sample_rate'],
-                    'num_samples': sound_info['num_samples'],
-                    'duration': sound_info['duration']
-                }
-                self.extracted_sounds.append(extracted_info)
-
-                self.status_text.insert(tk.END, f"\nExtracted Sound {sound_info['index']:02d}: {os.path.basename(wav_path)}")
-                self.status_text.insert(tk.END, f"\n  Sample Rate: {sound_info['sample_rate']} Hz")
-                self.status_text.insert(tk.END, f"\n  Duration: {sound_info['duration']:.2f}s\n")
-
-                self.progress_bar['value'] = progress_idx + 1
-                self.progress_label['text'] = f"Extracted {progress_idx + 1}/{len(selected_indices)}"
-                self.root.update()
+        base_name = os.path.splitext(self.uber_file)[0]
+        progress = self.progress_callback("Extracted")
+        profiler = self.start_profiler("extract")
 
-            self.root.update()
+        def work():
+            # Decoding uses the same number of processes as rebuild encoding
+            return extract_wavs(selected_sounds, base_name, self.pcm_cache, self.log_status, progress,
+                                profiler=profiler, writers=self.extract_writers,
+                                decode_workers=self.rebuild_workers)
 
-            self.status_text.insert(tk.END, f"\n{'='*54}\nExtraction complete! Created {len(selected_indices)} WAV file(s).")
-            self.root.update()
+        def on_done(extracted_sounds):
+            self.extracted_sounds = extracted_sounds
+            self.status_log.write(f"\n{'='*54}\nExtraction complete! Created {len(selected_sounds)} WAV file(s).")
+            self.reset_progress()
+            self.finish_profiler(profiler)
 
-            self.progress_bar['value'] = 0
-            self.progress_label['text'] = ""
-
-        except Exception as e:
-            self.status_text.insert(tk.END, f"\n\nERROR: {str(e)}")
-            self.progress_bar['value'] = 0
-            self.progress_label['text'] = ""
-            messagebox.showerror("Extraction Error", str(e))
+        self.run_in_background(work, on_done, self.profiled(self.on_extract_error, profiler),
+                               self.profiled(self.on_extract_cancelled, profiler))
 
     def extract_dsp(self):
         if not self.loaded_sounds:
             messagebox.showwarning("No Sounds Loaded", "Please load UBER and SAMP files first")
             return
 
-        selected_indices = [i for i, var in enumerate(self.sound_checkboxes) if var.get()]
+        selected_sounds = self.selected_sounds()
 
-        if not selected_indices:
+        if not selected_sounds:
             messagebox.showwarning("No Sounds Selected", "Please select at least one sound to extract")
             return
 
-        self.status_text.insert(tk.END, f"\nExtracting {len(selected_indices)} selected sound(s) as DSP...\n")
+        self.status_log.write(f"\nExtracting {len(selected_sounds)} selected sound(s) as DSP...\n")
         self.progress_bar['value'] = 0
-        self.progress_bar['maximum'] = len(selected_indices)
-        self.root.update()
-
-        try:
-            base_name = os.path.splitext(self.uber_file)[0]
-
-            for progress_idx, idx in enumerate(selected_indices):
-                sound_info = self.loaded_sounds[idx]
-                dsp_path = f"{base_name}_{sound_info['index']:02d}.dsp"
+        self.progress_bar['maximum'] = len(selected_sounds)
 
-                with open(dsp_path, 'wb') as dsp:
-                    dsp.write(sound_info['dsp_data'])
-
-                self.status_text.insert(tk.END, f"\nExtracted Sound {sound_info['index']:02d}: {os.path.basename(dsp_path)}")
-                self.status_text.insert(tk.END, f"\n  Sample Rate: {sound_info['sample_rate']} Hz")
-                self.status_text.insert(tk.END, f"\n  Duration: {sound_info['duration']:.2f}s\n")
+        base_name = os.path.splitext(self.uber_file)[0]
+        progress = self.progress_callback("Extracted")
+        profiler = self.start_profiler("extract_dsp")
 
-                self.progress_bar['value'] = progress_idx + 1
-                self.progress_label['text'] = f"Extracted {progress_idx + 1}/{len(selected_indices)}"
-                self.root.update()
+        def work():
+            extract_dsps(selected_sounds, base_name, self.log_status, progress, profiler,
+                         writers=self.extract_writers)
 
-            self.root.update()
+        def on_done(result):
+            self.status_log.write(f"\n{'='*54}\nExtraction complete! Created {len(selected_sounds)} DSP file(s).")
+            self.reset_progress()
+            self.finish_profiler(profiler)
 
-            self.status_text.insert(tk.END, f"\n{'='*54}\nExtraction complete! Created {len(selected_indices)} DSP file(s).")
-            self.root.update()
+        self.run_in_background(work, on_done, self.profiled(self.on_extract_error, profiler),
+                               self.profiled(self.on_extract_cancelled, profiler))
 
-            self.progress_bar['value'] = 0
-            self.progress_label['text'] = ""
+    def on_extract_error(self, e, details):
+        self.status_log.write(f"\n\nERROR: {str(e)}")
+        self.reset_progress()
+        messagebox.showerror("Extraction Error", str(e))
 
-        except Exception as e:
-            self.status_text.insert(tk.END, f"\n\nERROR: {str(e)}")
-            self.progress_bar['value'] = 0
-            self.progress_label['text'] = ""
-            messagebox.showerror("Extraction Error", str(e))
+    def on_extract_cancelled(self):
+        self.status_log.write("\n\nExtraction cancelled.")
+        self.reset_progress()
 
     def rebuild(self):
         if not self.loaded_sounds:
@@ -458,21 +673,7 @@ class AudioExtractor:
             return
 
         base_name = os.path.splitext(self.uber_file)[0]
-
-        sounds_to_rebuild = []
-        for sound_info in self.loaded_sounds:
-            wav_path = f"{base_name}_{sound_info['index']:02d}.wav"
-            dsp_path = f"{base_name}_{sound_info['index']:02d}.dsp"
-
-            if os.path.exists(wav_path) or os.path.exists(dsp_path):
-                rebuild_info = {
-                    'index': sound_info['index'],
-                    'wav_path': wav_path,
-                    'dsp_path': dsp_path,
-                    'dsp_data': sound_info['dsp_data'],
-                    'sample_rate': sound_info['sample_rate']
-                }
-                sounds_to_rebuild.append(rebuild_info)
+        sounds_to_rebuild = find_rebuild_sources(self.loaded_sounds, base_name)
 
         if not sounds_to_rebuild:
             messagebox.showwarning("No Files to Rebuild",
@@ -480,153 +681,84 @@ class AudioExtractor:
                 "Please extract sounds or place edited files in the same directory as the UBER file.")
             return
 
-        self.status_text.insert(tk.END, "\nStarting rebuild with UBER and SAMP patching...\n")
-        self.status_text.insert(tk.END, f"Found {len(sounds_to_rebuild)} sound(s) to rebuild\n")
+        self.status_log.write("\nStarting rebuild with UBER and SAMP patching...\n")
+        self.status_log.write(f"Found {len(sounds_to_rebuild)} sound(s) to rebuild\n")
         self.progress_bar['value'] = 0
         self.progress_bar['maximum'] = len(sounds_to_rebuild)
-        self.root.update()
 
-        try:
-            converted_count = 0
-            for progress_idx, sound_info in enumerate(sounds_to_rebuild):
-                wav_path = sound_info['wav_path']
-                dsp_path = sound_info['dsp_path']
-                original_dsp_data = sound_info['dsp_data']
-
-                wav_exists = os.path.exists(wav_path)
-                dsp_exists = os.path.exists(dsp_path)
-
-                if not wav_exists and not dsp_exists:
-                    self.status_text.insert(tk.END,
-                        f"\nSkipped Sound {sound_info['index']:02d}: Neither WAV nor DSP file found")
-                    continue
-
-                self.status_text.insert(tk.END,
-                    f"\n\nProcessing Sound {sound_info['index']:02d}")
-
-                if dsp_exists and not wav_exists:
-                    self.status_text.insert(tk.END, f": Using existing DSP file")
-                    with open(dsp_path, 'rb') as dsp:
-                        new_dsp_data = dsp.read()
-
-                    self.status_text.insert(tk.END,
-                        f"\n  Step 1: Loaded existing DSP ({len(new_dsp_data)} bytes)")
-                else:
-                    self.status_text.insert(tk.END, f": {os.path.basename(wav_path)}")
-
-                    samples, wav_sample_rate = read_wav_file(wav_path)
-                    original_sample_rate = sound_info['sample_rate']
-
-                    if wav_sample_rate != original_sample_rate:
-                        self.status_text.insert(tk.END,
-                            f"\n  Resampling from {wav_sample_rate} Hz to {original_sample_rate} Hz...")
-                        samples = resample_audio(samples, wav_sample_rate, original_sample_rate)
-
-                    num_samples = len(samples)
-
-                    coefficients = original_dsp_data[0x1C:0x3C]
-                    adpcm_data = encode_dsp_adpcm(samples, coefficients)
-                    num_nibbles = len(adpcm_data) * 2
-                    ps = original_dsp_data[0x3F]
-
-                    new_dsp_data = create_dsp_file(num_samples, num_nibbles, original_sample_rate,
-                                                    coefficients, ps, adpcm_data)
-
-                    with open(dsp_path, 'wb') as dsp:
-                        dsp.write(new_dsp_data)
-
-                    self.status_text.insert(tk.END,
-                        f"\n  Step 1: Converted to DSP ({len(new_dsp_data)} bytes)")
-
-                pattern_for_uber = original_dsp_data[0x1C:0x3C]
-                self.status_text.insert(tk.END,
-                    f"\n  Step 2: Searching for pattern in UBER (bytes 0x1C-0x3B)...")
-
-                uber_offset = find_pattern_in_file(self.uber_file, pattern_for_uber)
-                if uber_offset is not None:
-                    replacement_data = new_dsp_data[0x1C:0x3C]
-                    replace_bytes_in_file(self.uber_file, uber_offset, replacement_data)
-                    self.status_text.insert(tk.END,
-                        f"\n  Step 3: Replaced in UBER at offset 0x{uber_offset:X}")
-                else:
-                    self.status_text.insert(tk.END,
-                        f"\n  Step 3: Pattern not found in UBER - skipping UBER patch")
-
-                pattern_for_samp = original_dsp_data[0x60:]
-                self.status_text.insert(tk.END,
-                    f"\n  Step 4: Searching for audio data in SAMP (from offset 0x60)...")
-
-                samp_offset = find_pattern_in_file(self.samp_file, pattern_for_samp)
-                if samp_offset is not None:
-                    new_audio_data = new_dsp_data[0x60:]
-                    original_length = len(pattern_for_samp)
-                    new_length = len(new_audio_data)
-
-                    if new_length < original_length:
-                        padding_needed = original_length - new_length
-                        new_audio_data = new_audio_data + (b'\x00' * padding_needed)
-                        self.status_text.insert(tk.END,
-                            f"\n  Step 5: Added {padding_needed} bytes padding to match original length")
-                    elif new_length > original_length:
-                        new_audio_data = new_audio_data[:original_length]
-                        self.status_text.insert(tk.END,
-                            f"\n  Step 5: Trimmed {new_length - original_length} bytes to match original length")
-                    else:
-                        self.status_text.insert(tk.END,
-                            f"\n  Step 5: Length matches exactly ({new_length} bytes)")
-
-                    replace_bytes_in_file(self.samp_file, samp_offset, new_audio_data)
-                    self.status_text.insert(tk.END,
-                        f"\n  Step 6: Replaced in SAMP at offset 0x{samp_offset:X}")
-                else:
-                    self.status_text.insert(tk.END,
-                        f"\n  Step 5: Audio data not found in SAMP - skipping SAMP patch")
-
-                converted_count += 1
-
-                self.progress_bar['value'] = progress_idx + 1
-                self.progress_label['text'] = f"Processing {progress_idx + 1}/{len(sounds_to_rebuild)}"
-                self.root.update()
-
-            self.status_text.insert(tk.END,
-                f"\n\n{'='*53}\nRebuild complete! Processed {converted_count} sound(s).")
-            self.status_text.insert(tk.END,
-                f"\nUBER and SAMP files have been patched with new audio data.")
-
-            # Clean up generated DSP files (keep DSPs without WAVs - those are edited raw DSPs)
-            deleted_dsp_count = 0
-            uber_dir = os.path.dirname(self.uber_file) or '.'
-            for dsp_file in Path(uber_dir).glob("*.dsp"):
-                wav_file = dsp_file.with_suffix('.wav')
-                if wav_file.exists():
-                    dsp_file.unlink()
-                    deleted_dsp_count += 1
-
-            if deleted_dsp_count > 0:
-                self.status_text.insert(tk.END,
-                    f"\nCleaned up {deleted_dsp_count} generated DSP file(s).")
-
-            self.status_text.insert(tk.END,
+        # The sources hold views into the mapped SAMP; the worker takes the
+        # only reference so they are gone once planning returns.
+        job = {'sources': sounds_to_rebuild}
+        sounds_to_rebuild = None
+        uber_file, samp_file = self.uber_file, self.samp_file
+        rebuild_index, workers, resample_mode = self.rebuild_index, self.rebuild_workers, self.resample_mode
+        progress = self.progress_callback("Processing")
+        profiler = self.start_profiler("rebuild")
+        manifest = RebuildManifest.load(manifest_path(base_name))
+
+        def plan():
+            return plan_rebuild(uber_file, samp_file, job.pop('sources'), rebuild_index,
+                                workers, self.log_status, progress, resample_mode, profiler, manifest)
+
+        def on_planned(result):
+            patch_plan, converted_count = result
+            writers = self.release_loaded_sounds()
+
+            def finish():
+                for writer in writers:
+                    writer.join()
+                return finish_rebuild(patch_plan, converted_count, self.log_status, profiler, manifest)
+
+            self.progress_label['text'] = "Writing UBER and SAMP..."
+            self.status_log.write("\nWriting the UBER and SAMP changes; this step cannot be cancelled.")
+            self.run_in_background(finish, on_finished, self.profiled(self.on_rebuild_error, profiler))
+
+        def on_finished(result):
+            self.finish_profiler(profiler)
+            self.status_log.write(
                 f"\n\nRefreshing loaded sounds...")
 
             self.progress_bar['value'] = 0
             self.progress_label['text'] = "Refreshing..."
-            self.root.update()
 
             self.auto_load()
 
-            self.progress_bar['value'] = 0
-            self.progress_label['text'] = ""
+        self.run_in_background(plan, on_planned, self.profiled(self.on_rebuild_error, profiler),
+                               self.profiled(self.on_rebuild_cancelled, profiler))
+
+    def profiled(self, callback, profiler):
+        # Failed and cancelled runs stop tracing but leave no report
+        def finish(*args):
+            self.finish_profiler(profiler, write_report=False)
+            callback(*args)
+        return finish
+
+    def on_rebuild_error(self, e, details):
+        self.status_log.write(f"\n\nERROR: {str(e)}")
+        self.status_log.write(f"\n{details}")
+        self.reset_progress()
+        messagebox.showerror("Rebuild Error", str(e))
+        if not self.loaded_sounds:
+            self.auto_load()
 
-        except Exception as e:
-            self.status_text.insert(tk.END, f"\n\nERROR: {str(e)}")
-            import traceback
-            self.status_text.insert(tk.END, f"\n{traceback.format_exc()}")
-            self.progress_bar['value'] = 0
-            self.progress_label['text'] = ""
-            messagebox.showerror("Rebuild Error", str(e))
+    def on_rebuild_cancelled(self):
+        self.status_log.write("\n\nRebuild cancelled. UBER and SAMP files were not modified.")
+        self.reset_progress()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract and rebuild UBER/SAMP sound banks.")
+    parser.add_argument("--profile", metavar="DIR",
+                        help="show per-stage timings after each operation and save JSON reports to DIR")
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="with --profile, also record peak memory per stage (slower)")
+    parser.add_argument("--log-file", metavar="PATH",
+                        help="append the full status log to PATH; the window only keeps the latest lines")
+    parser.add_argument("--status-lines", type=int, default=DEFAULT_STATUS_LINES, metavar="N",
+                        help=f"number of status lines kept in the window (default {DEFAULT_STATUS_LINES})")
+    parser.add_argument("--writers", type=int, default=DEFAULT_WRITE_THREADS, metavar="N",
+                        help="number of files written at once when extracting (default %(default)s)")
+    args = parser.parse_args(argv)
 
-def main():
     try:
         from tkinterdnd2 import TkinterDnD
         root = TkinterDnD.Tk()
@@ -634,7 +766,9 @@ def main():
         root = tk.Tk()
         print("Warning: tkinterdnd2 not available. Drag and drop will not work.")
 
-    app = AudioExtractor(root)
+    app = AudioExtractor(root, profile_dir=args.profile, trace_memory=args.trace_memory,
+                         log_file=args.log_file, status_lines=args.status_lines,
+                         extract_writers=max(1, args.writers))
     root.mainloop()
 
 if __name__ == "__main__":
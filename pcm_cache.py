@@ -0,0 +1,390 @@
+import hashlib
+import os
+import struct
+import sys
+import tempfile
+import threading
+import zlib
+from array import array
+from collections import OrderedDict, deque
+
+from dsp_codec import (decode_dsp_adpcm_many, iter_decode_dsp_adpcm, DecodeCheckpoints, CHECKPOINT_FRAMES,
+                       STREAM_CHUNK_SAMPLES)
+
+DEFAULT_PCM_CACHE_BYTES = 256 * 1024 * 1024
+DEFAULT_DISK_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+DECODE_BATCH_SOUNDS = 64
+
+# magic, sample count, crc32 of the little-endian int16 payload that follows
+DISK_CACHE_HEADER = struct.Struct("<4sII4x")
+DISK_CACHE_MAGIC = b"USMP"
+# magic, checkpoint interval in frames, history entry count, crc32 of the entries
+DISK_CHECKPOINT_HEADER = struct.Struct("<4sIII")
+DISK_CHECKPOINT_MAGIC = b"USMC"
+
+def default_cache_dir():
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or os.path.join(os.path.expanduser("~"), "AppData", "Local")
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "unleashed-sound-manager", "pcm")
+
+def pcm_content_key(sound_info):
+    # Sounds with the same key decode to the same PCM, whichever container
+    # or index they come from.
+    if sound_info.content_key is None:
+        digest = hashlib.blake2b(digest_size=20)
+        digest.update(sound_info.adpcm_data)
+        digest.update(sound_info.coefficients)
+        digest.update(struct.pack("<BI", sound_info.ps, max(0, sound_info.num_samples)))
+        sound_info.content_key = digest.hexdigest()
+    return sound_info.content_key
+
+def decode_pcm_jobs(jobs):
+    # Pool entry point; arrays pickle far smaller than lists of ints
+    return [array('h', samples) for samples in decode_dsp_adpcm_many(jobs)]
+
+class DiskPCMCache:
+    def __init__(self, directory=None, max_bytes=DEFAULT_DISK_CACHE_BYTES):
+        self.directory = directory or default_cache_dir()
+        self.max_bytes = max_bytes
+        self.current_bytes = None
+        # Decoded sounds are written from whichever thread decoded them
+        self.lock = threading.Lock()
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, key, extension=".pcm"):
+        return os.path.join(self.directory, key[:2], key + extension)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(DISK_CACHE_HEADER.size)
+                raw = f.read()
+        except OSError:
+            return None
+
+        if len(header) == DISK_CACHE_HEADER.size:
+            magic, num_samples, checksum = DISK_CACHE_HEADER.unpack(header)
+            if magic == DISK_CACHE_MAGIC and len(raw) == num_samples * 2 and zlib.crc32(raw) == checksum:
+                self._touch(path)
+                return _int16_array(raw)
+
+        self._remove(path)
+        return None
+
+    def get_range(self, key, start, end=None):
+        # Reads only samples [start, end) of a cached sound. The checksum
+        # covers the whole file, so here only the header and size are checked.
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(DISK_CACHE_HEADER.size)
+                if len(header) < DISK_CACHE_HEADER.size:
+                    return None
+                magic, num_samples, _ = DISK_CACHE_HEADER.unpack(header)
+                if magic != DISK_CACHE_MAGIC or os.fstat(f.fileno()).st_size != len(header) + num_samples * 2:
+                    return None
+                end = num_samples if end is None else min(end, num_samples)
+                start = min(start, end)
+                f.seek(len(header) + start * 2)
+                raw = f.read((end - start) * 2)
+        except OSError:
+            return None
+
+        self._touch(path)
+        return _int16_array(raw)
+
+    def put(self, key, pcm):
+        raw = _int16_bytes(pcm)
+        self._write(self._path(key), DISK_CACHE_HEADER.pack(DISK_CACHE_MAGIC, len(raw) // 2, zlib.crc32(raw)), raw)
+
+    def get_checkpoints(self, key):
+        path = self._path(key, ".ckpt")
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(DISK_CHECKPOINT_HEADER.size)
+                raw = f.read()
+        except OSError:
+            return None
+
+        if len(header) == DISK_CHECKPOINT_HEADER.size:
+            magic, interval_frames, count, checksum = DISK_CHECKPOINT_HEADER.unpack(header)
+            if magic == DISK_CHECKPOINT_MAGIC and len(raw) == count * 2 and zlib.crc32(raw) == checksum:
+                self._touch(path)
+                return DecodeCheckpoints(interval_frames, _int16_array(raw))
+
+        self._remove(path)
+        return None
+
+    def put_checkpoints(self, key, checkpoints):
+        raw = _int16_bytes(checkpoints.history)
+        header = DISK_CHECKPOINT_HEADER.pack(DISK_CHECKPOINT_MAGIC, checkpoints.interval_frames,
+                                             len(raw) // 2, zlib.crc32(raw))
+        self._write(self._path(key, ".ckpt"), header, raw)
+
+    def _write(self, path, header, raw):
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, temp_path = tempfile.mkstemp(suffix=".tmp", dir=os.path.dirname(path))
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(header)
+                f.write(raw)
+            os.replace(temp_path, path)
+        except OSError:
+            # A full disk must not leave half-written files behind
+            self._remove(temp_path)
+            return
+
+        with self.lock:
+            if self.current_bytes is not None:
+                self.current_bytes += len(header) + len(raw)
+            if self.current_bytes is None or self.current_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # Least recently used first; hits refresh the file's mtime.
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith((".pcm", ".ckpt")):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    files.append((st.st_mtime, st.st_size, path))
+
+        self.current_bytes = sum(size for _, size, _ in files)
+        if self.current_bytes <= self.max_bytes:
+            return
+
+        target = self.max_bytes * 9 // 10
+        for _, size, path in sorted(files):
+            if self.current_bytes <= target:
+                break
+            if self._remove(path):
+                self.current_bytes -= size
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except OSError:
+            return False
+
+def _int16_array(raw):
+    # The cache files are little-endian whatever the machine
+    pcm = array('h')
+    pcm.frombytes(raw)
+    if sys.byteorder == 'big':
+        pcm.byteswap()
+    return pcm
+
+def _int16_bytes(pcm):
+    raw = array('h', pcm)
+    if sys.byteorder == 'big':
+        raw.byteswap()
+    return raw.tobytes()
+
+def _decode_job(sound_info):
+    return sound_info.adpcm_data, sound_info.coefficients, sound_info.ps, sound_info.num_samples
+
+class PCMCache:
+    def __init__(self, max_bytes=DEFAULT_PCM_CACHE_BYTES, disk_cache=None):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.entries = OrderedDict()
+        self.disk_cache = disk_cache
+        # Checkpoints are a few bytes per second of audio, so they outlive
+        # the PCM they were taken from and make later range decodes cheap.
+        self.checkpoints = {}
+        # Extraction runs on a worker thread while previews read from the main one
+        self.lock = threading.RLock()
+
+    def get(self, sound_info):
+        return self.get_many([sound_info])[0]
+
+    def peek(self, sound_info):
+        with self.lock:
+            return self.entries.get(pcm_content_key(sound_info))
+
+    def get_many(self, sound_infos):
+        # The lock is only held to look up and store entries, so a preview
+        # on the main thread never waits behind a decode or disk read.
+        keys, found, missing = self._lookup(sound_infos)
+        if missing:
+            decoded = decode_dsp_adpcm_many([_decode_job(sound_infos[pos]) for pos in missing])
+            for pos, samples in zip(missing, decoded):
+                found[keys[pos]] = self._store(keys[pos], array('h', samples))
+        return [found[key] for key in keys]
+
+    def _lookup(self, sound_infos):
+        # Returns the content keys, the PCM found in memory or on disk by
+        # key, and the positions of the sounds that still need decoding.
+        keys = [pcm_content_key(sound_info) for sound_info in sound_infos]
+        found = {}
+        missing = []
+
+        with self.lock:
+            for pos, key in enumerate(keys):
+                if key in found:
+                    continue
+                pcm = self.entries.get(key)
+                if pcm is None:
+                    # Repeats of the same payload in this batch are decoded once
+                    found[key] = None
+                    missing.append(pos)
+                else:
+                    self.entries.move_to_end(key)
+                    found[key] = pcm
+
+        if missing and self.disk_cache is not None:
+            still_missing = []
+            for pos in missing:
+                pcm = self.disk_cache.get(keys[pos])
+                if pcm is None:
+                    still_missing.append(pos)
+                else:
+                    checkpoints = DecodeCheckpoints.from_pcm(pcm)
+                    with self.lock:
+                        self.put(keys[pos], pcm)
+                        self.checkpoints[keys[pos]] = checkpoints
+                    found[keys[pos]] = pcm
+            missing = still_missing
+
+        return keys, found, missing
+
+    def _store(self, key, pcm):
+        checkpoints = DecodeCheckpoints.from_pcm(pcm)
+        with self.lock:
+            self.put(key, pcm)
+            self.checkpoints[key] = checkpoints
+        if self.disk_cache is not None:
+            self.disk_cache.put(key, pcm)
+        return pcm
+
+    def iter_range(self, sound_info, start=0, end=None, chunk_samples=STREAM_CHUNK_SAMPLES):
+        key = pcm_content_key(sound_info)
+        pcm = self.peek(sound_info)
+        if pcm is None and self.disk_cache is not None:
+            if start == 0 and end is None:
+                pcm = self.disk_cache.get(key)
+                if pcm is not None:
+                    with self.lock:
+                        self.put(key, pcm)
+                        self.checkpoints[key] = DecodeCheckpoints.from_pcm(pcm)
+            else:
+                # Only the requested part is read back from the cache file
+                pcm = self.disk_cache.get_range(key, start, end)
+                if pcm is not None:
+                    start, end = 0, None
+
+        if pcm is not None:
+            end = len(pcm) if end is None else min(end, len(pcm))
+            for pos in range(start, end, chunk_samples):
+                yield pcm[pos:min(pos + chunk_samples, end)]
+            return
+
+        # Decoding starts at the nearest checkpoint before start, and the
+        # checkpoints passed on the way are kept for the next range.
+        with self.lock:
+            checkpoints = self.checkpoints.get(key)
+        if checkpoints is None and self.disk_cache is not None:
+            checkpoints = self.disk_cache.get_checkpoints(key)
+        if checkpoints is not None and checkpoints.interval_frames != CHECKPOINT_FRAMES:
+            checkpoints = None
+        if checkpoints is not None:
+            record = checkpoints.copy()
+        else:
+            record = DecodeCheckpoints(CHECKPOINT_FRAMES, array('h', (0, 0)))
+        yield from iter_decode_dsp_adpcm(sound_info.adpcm_data, sound_info.coefficients, sound_info.ps,
+                                         sound_info.num_samples, start, end, chunk_samples, checkpoints, record)
+
+        if checkpoints is None or len(record.history) > len(checkpoints.history):
+            with self.lock:
+                known = self.checkpoints.get(key)
+                if known is None or len(known.history) < len(record.history):
+                    self.checkpoints[key] = record
+            if self.disk_cache is not None:
+                self.disk_cache.put_checkpoints(key, record)
+
+    def iter_pcm(self, sound_infos, batch_size=DECODE_BATCH_SOUNDS, executor=None, prefetch=1):
+        batches = (sound_infos[start:start + batch_size] for start in range(0, len(sound_infos), batch_size))
+        if executor is None:
+            for batch in batches:
+                yield from zip(batch, self.get_many(batch))
+            return
+
+        # Up to prefetch batches beyond the one being consumed are decoding
+        # on the pool; results still come back in order. in_flight maps the
+        # key of every payload submitted but not yet stored to its future.
+        pending = deque()
+        in_flight = {}
+        for batch in batches:
+            pending.append(self._submit_batch(batch, executor, in_flight))
+            if len(pending) > prefetch:
+                yield from self._finish_batch(*pending.popleft(), in_flight)
+        while pending:
+            yield from self._finish_batch(*pending.popleft(), in_flight)
+
+    def _submit_batch(self, batch, executor, in_flight):
+        keys, found, missing = self._lookup(batch)
+        # A payload still decoding for an earlier batch is taken from that
+        # batch's result instead of being decoded a second time.
+        borrowed = {keys[pos]: in_flight[keys[pos]] for pos in missing if keys[pos] in in_flight}
+        missing = [pos for pos in missing if keys[pos] not in borrowed]
+        future = None
+        if missing:
+            # Views into the mapped SAMP cannot be pickled
+            jobs = [_decode_job(batch[pos]) for pos in missing]
+            future = executor.submit(decode_pcm_jobs, [(bytes(data), *rest) for data, *rest in jobs])
+            for i, pos in enumerate(missing):
+                in_flight[keys[pos]] = (future, i)
+        return batch, keys, found, missing, future, borrowed
+
+    def _finish_batch(self, batch, keys, found, missing, future, borrowed, in_flight):
+        if future is not None:
+            decoded = future.result()
+            for pos, pcm in zip(missing, decoded):
+                found[keys[pos]] = self._store(keys[pos], pcm)
+                del in_flight[keys[pos]]
+        for key, (other, i) in borrowed.items():
+            found[key] = other.result()[i]
+        return zip(batch, (found[key] for key in keys))
+
+    def put(self, key, pcm):
+        size = len(pcm) * pcm.itemsize
+        with self.lock:
+            self.discard(key)
+            if size > self.max_bytes:
+                return
+
+            self.entries[key] = pcm
+            self.current_bytes += size
+
+            while self.current_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.current_bytes -= len(evicted) * evicted.itemsize
+
+    def discard(self, key):
+        with self.lock:
+            pcm = self.entries.pop(key, None)
+            if pcm is not None:
+                self.current_bytes -= len(pcm) * pcm.itemsize
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.checkpoints.clear()
+            self.current_bytes = 0
@@ -0,0 +1,143 @@
+import atexit
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+from dsp_codec import decodable_samples
+from file_operations import wav_header, pcm16_bytes
+
+DEFAULT_PREVIEW_CACHE_BYTES = 512 * 1024 * 1024
+PREVIEW_FAST_START_SECONDS = 5
+
+class PreviewCache:
+    def __init__(self, pcm_cache, max_bytes=DEFAULT_PREVIEW_CACHE_BYTES,
+                 fast_start_seconds=PREVIEW_FAST_START_SECONDS):
+        self.pcm_cache = pcm_cache
+        self.max_bytes = max_bytes
+        self.fast_start_seconds = fast_start_seconds
+        self.directory = tempfile.mkdtemp(prefix="usm-preview-")
+        self.generation = 0
+        self.entries = OrderedDict()
+        self.current_bytes = 0
+        self.stale_paths = []
+        self.writers = {}
+        self.stop_event = threading.Event()
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    def get(self, sound_info):
+        # Returns a playable WAV path. A sound that still needs decoding gets
+        # its first few seconds written now and the rest appended by a thread.
+        index = sound_info.index
+
+        with self.lock:
+            if index in self.entries:
+                self.entries.move_to_end(index)
+                return self.entries[index][0]
+            if index in self.writers:
+                return self.writers[index][0]
+            # Files from an earlier load keep their names until they can be
+            # deleted, so every load writes under its own prefix.
+            path = os.path.join(self.directory, f"preview_{self.generation:03d}_{index:04d}.wav")
+
+        num_samples = decodable_samples(len(sound_info.adpcm_data), sound_info.num_samples)
+        head_samples = self.fast_start_seconds * sound_info.sample_rate
+        cached = self.pcm_cache.peek(sound_info) is not None
+
+        # The decode stream is shared: the first chunk is written before the
+        # player opens, and the same generator carries on in the background.
+        chunks = self.pcm_cache.iter_range(sound_info, chunk_samples=max(14, head_samples))
+        wav = open(path, 'wb')
+        try:
+            wav.write(wav_header(num_samples, sound_info.sample_rate))
+            if cached or num_samples <= head_samples:
+                for chunk in chunks:
+                    wav.write(pcm16_bytes(chunk))
+                wav.close()
+                self._add(index, path)
+                return path
+
+            wav.write(pcm16_bytes(next(chunks)))
+            wav.flush()
+        except Exception:
+            wav.close()
+            raise
+
+        with self.lock:
+            stop = self.stop_event
+            writer = threading.Thread(target=self._finish, args=(wav, path, index, chunks, stop), daemon=True)
+            self.writers[index] = (path, writer)
+        writer.start()
+        return path
+
+    def _finish(self, wav, path, index, chunks, stop):
+        try:
+            with wav:
+                for chunk in chunks:
+                    if stop.is_set():
+                        break
+                    wav.write(pcm16_bytes(chunk))
+            self._add(index, path, stop)
+        except (OSError, ValueError):
+            pass
+        finally:
+            # Closing the stream drops its views into the mapped SAMP
+            chunks.close()
+            with self.lock:
+                if self.writers.get(index, (None,))[0] == path:
+                    del self.writers[index]
+
+    def _add(self, index, path, stop=None):
+        size = os.path.getsize(path)
+        with self.lock:
+            if stop is not None and stop.is_set():
+                # Cleared while writing: the file belongs to an earlier load
+                if not self._remove(path):
+                    self.stale_paths.append(path)
+                return
+            self.entries[index] = (path, size)
+            self.current_bytes += size
+
+            # Oldest previews go first; a file the player still holds open is
+            # kept and retried on the next addition.
+            for old_index in list(self.entries):
+                if self.current_bytes <= self.max_bytes or old_index == index:
+                    break
+                old_path, old_size = self.entries[old_index]
+                if self._remove(old_path):
+                    del self.entries[old_index]
+                    self.current_bytes -= old_size
+
+            self.stale_paths = [p for p in self.stale_paths if not self._remove(p)]
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError:
+            return False
+
+    def clear(self):
+        # Pending writers still hold views into the mapped SAMP. They stop at
+        # their next chunk and throw the partial file away; waiting for them
+        # here would hold up the UI, so they are returned for the caller to
+        # join off the Tk thread when it needs the mapping gone.
+        with self.lock:
+            self.stop_event.set()
+            self.stop_event = threading.Event()
+            writers = [writer for _, writer in self.writers.values()]
+            self.writers.clear()
+            for path, _ in self.entries.values():
+                if not self._remove(path):
+                    self.stale_paths.append(path)
+            self.entries.clear()
+            self.current_bytes = 0
+            self.generation += 1
+        return writers
+
+    def close(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
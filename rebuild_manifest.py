@@ -0,0 +1,105 @@
+import hashlib
+import json
+import os
+import shutil
+import struct
+
+from file_operations import read_wav_info, iter_wav_samples, pcm16_bytes
+
+MANIFEST_VERSION = 1
+
+def manifest_path(base_name):
+    # Lives next to the extracted files, which share the same base name
+    return base_name + ".rebuild.json"
+
+def _digest():
+    return hashlib.blake2b(digest_size=20)
+
+def pcm_hash(chunks, sample_rate):
+    digest = _digest()
+    digest.update(struct.pack("<I", sample_rate))
+    for chunk in chunks:
+        digest.update(pcm16_bytes(chunk))
+    return digest.hexdigest()
+
+def data_hash(*parts):
+    digest = _digest()
+    for part in parts:
+        digest.update(part)
+    return digest.hexdigest()
+
+def source_hash(wav_path, dsp_path):
+    # (kind, hash, sample rate) of the file a rebuild would read for a sound.
+    # WAVs are hashed by the mono PCM they encode to, so re-saving one
+    # without touching the audio does not count as an edit.
+    if os.path.exists(wav_path):
+        with open(wav_path, 'rb') as wav_file:
+            sample_rate = read_wav_info(wav_file)['sample_rate']
+        return 'wav', pcm_hash(iter_wav_samples(wav_path), sample_rate), sample_rate
+    if os.path.exists(dsp_path):
+        with open(dsp_path, 'rb') as dsp:
+            return 'dsp', data_hash(dsp.read()), None
+    return None
+
+class RebuildManifest:
+    def __init__(self, path, sounds=None):
+        self.path = path
+        self.sounds = sounds or {}
+        self.pending = {}
+
+    @classmethod
+    def load(cls, path):
+        # A missing or damaged manifest only means nothing can be skipped
+        try:
+            with open(path, 'r') as f:
+                data = json.load(f)
+            if data.get('version') == MANIFEST_VERSION and isinstance(data.get('sounds'), dict):
+                return cls(path, data['sounds'])
+        except (OSError, ValueError, AttributeError):
+            pass
+        return cls(path)
+
+    def is_current(self, index, source, samp_hash, resample_mode):
+        if source is None:
+            return False
+        kind, content_hash, _ = source
+        entry = self.sounds.get(str(index), {}).get(kind)
+        return (entry is not None and entry['hash'] == content_hash and entry['samp'] == samp_hash
+                and entry.get('resample_mode') == resample_mode)
+
+    def record(self, index, source, samp_hash, resample_mode=None):
+        kind, content_hash, _ = source
+        self.sounds.setdefault(str(index), {})[kind] = {
+            'hash': content_hash,
+            'samp': samp_hash,
+            'resample_mode': resample_mode
+        }
+
+    def stage(self, index, source, samp_hash, resample_mode=None):
+        # Held back until the patches are written
+        self.pending[index] = (source, samp_hash, resample_mode)
+
+    def commit(self):
+        # The SAMP bytes of a rebuilt sound changed, so anything recorded
+        # for its other source kind no longer applies.
+        for index, (source, samp_hash, resample_mode) in self.pending.items():
+            self.sounds.pop(str(index), None)
+            self.record(index, source, samp_hash, resample_mode)
+        self.pending = {}
+        self.save()
+
+    def save(self):
+        # Created like any other file, so the umask applies; mkstemp would
+        # leave it readable by its owner only.
+        temp_path = f"{self.path}.{os.urandom(4).hex()}.tmp"
+        fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': MANIFEST_VERSION, 'sounds': self.sounds}, f, indent=1, sort_keys=True)
+            if os.path.exists(self.path):
+                shutil.copymode(self.path, temp_path)
+            os.replace(temp_path, self.path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
@@ -0,0 +1,191 @@
+import math
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+RESAMPLE_MODES = ("linear", "sinc")
+DEFAULT_RESAMPLE_MODE = "sinc"
+
+# Windowed-sinc filter: zero crossings kept on each side of the centre tap,
+# passband edge as a fraction of the lower Nyquist rate, and the most
+# filter phases tabulated before fractional positions are quantized.
+SINC_ZERO_CROSSINGS = 16
+SINC_ROLLOFF = 0.945
+MAX_SINC_PHASES = 4096
+RESAMPLE_BLOCK_OUTPUTS = 1 << 14
+
+class StreamResampler:
+    def __init__(self, original_rate, target_rate, mode=DEFAULT_RESAMPLE_MODE):
+        if mode not in RESAMPLE_MODES:
+            raise ValueError(f"Unknown resample mode: {mode}")
+
+        self.mode = mode
+        self.ratio = target_rate / original_rate
+        divisor = math.gcd(original_rate, target_rate)
+        self.up = target_rate // divisor
+        self.down = original_rate // divisor
+
+        self.received = 0
+        self.produced = 0
+        self.buffer = array('h')
+        self.buffer_start = 0
+
+        if mode == "sinc":
+            self.half_taps, self.phases, self.table = _sinc_table(self.up, self.down)
+            # Input before the first sample reads as silence
+            self.buffer.extend([0] * self.half_taps)
+            self.buffer_start = -self.half_taps
+
+    def process(self, block):
+        self.buffer.extend(block)
+        self.received += len(block)
+        return self._emit(False)
+
+    def flush(self):
+        if self.mode == "sinc":
+            self.buffer.extend([0] * self.half_taps)
+        return self._emit(True)
+
+    def _emit(self, final):
+        end = self._linear_end(final) if self.mode == "linear" else self._sinc_end(final)
+        output = array('h')
+        while self.produced < end:
+            stop = min(end, self.produced + RESAMPLE_BLOCK_OUTPUTS)
+            if self.mode == "linear":
+                output.extend(self._linear_block(self.produced, stop))
+            else:
+                output.extend(self._sinc_block(self.produced, stop))
+            self.produced = stop
+
+        # Drop input that no later output can reach
+        if self.mode == "linear":
+            keep_from = min(int(self.produced / self.ratio), max(0, self.received - 1))
+        else:
+            keep_from = self.produced * self.down // self.up - self.half_taps + 1
+        if keep_from > self.buffer_start:
+            del self.buffer[:keep_from - self.buffer_start]
+            self.buffer_start = keep_from
+        return output
+
+    def _linear_end(self, final):
+        total = self.received
+        if final:
+            return max(self.produced, int(total * self.ratio))
+
+        # Output i interpolates input int(i / ratio) and the sample after it,
+        # so it can only be produced once that next sample has arrived.
+        end = max(self.produced, int((total - 1) * self.ratio) - 1)
+        while int(end / self.ratio) + 1 < total:
+            end += 1
+        while end > self.produced and int((end - 1) / self.ratio) + 1 >= total:
+            end -= 1
+        # Never run past the final length the whole input would give
+        return max(self.produced, min(end, int(total * self.ratio)))
+
+    def _linear_block(self, start, stop):
+        # Same arithmetic as the original per-sample loop, so output is identical
+        total = self.received
+        buffer = self.buffer
+        base = self.buffer_start
+
+        if np is not None:
+            x = np.frombuffer(buffer, dtype=np.int16)
+            pos = np.arange(start, stop, dtype=np.float64) / self.ratio
+            idx = pos.astype(np.int64)
+            frac = pos - idx
+            local = idx - base
+            current = x[local].astype(np.float64)
+            following = x[np.minimum(local + 1, len(x) - 1)].astype(np.float64)
+            values = np.trunc(current * (1 - frac) + following * frac)
+            values = np.where(idx + 1 < total, values, current)
+            return array('h', values.astype(np.int16).tobytes())
+
+        output = array('h')
+        for i in range(start, stop):
+            src_pos = i / self.ratio
+            src_index = int(src_pos)
+            frac = src_pos - src_index
+            local = src_index - base
+
+            if src_index + 1 < total:
+                output.append(int(buffer[local] * (1 - frac) + buffer[local + 1] * frac))
+            else:
+                output.append(buffer[local])
+        return output
+
+    def _sinc_end(self, final):
+        if final:
+            return max(self.produced, self.received * self.up // self.down)
+
+        # Output n needs input up to (n * down) // up + half_taps
+        available = self.received - self.half_taps
+        if available <= 0:
+            return self.produced
+        return max(self.produced, -(-available * self.up // self.down))
+
+    def _sinc_block(self, start, stop):
+        taps = 2 * self.half_taps
+
+        if np is not None:
+            x = np.frombuffer(self.buffer, dtype=np.int16).astype(np.float64)
+            n = np.arange(start, stop, dtype=np.int64)
+            position = n * self.down
+            first = position // self.up - self.half_taps + 1 - self.buffer_start
+            phase = (position % self.up) * self.phases // self.up
+            window = x[first[:, None] + np.arange(taps)]
+            values = np.einsum('ij,ij->i', window, self.table[phase])
+            values = np.clip(np.rint(values), -32768, 32767)
+            return array('h', values.astype(np.int16).tobytes())
+
+        output = array('h')
+        for n in range(start, stop):
+            position = n * self.down
+            first = position // self.up - self.half_taps + 1 - self.buffer_start
+            coefs = self.table[(position % self.up) * self.phases // self.up]
+            value = 0.0
+            for j in range(taps):
+                value += self.buffer[first + j] * coefs[j]
+            output.append(max(-32768, min(32767, round(value))))
+        return output
+
+def _sinc_table(up, down):
+    cutoff = min(1.0, up / down) * SINC_ROLLOFF
+    half_taps = int(math.ceil(SINC_ZERO_CROSSINGS / cutoff))
+    phases = min(up, MAX_SINC_PHASES)
+
+    table = []
+    for p in range(phases):
+        offset = p / phases
+        row = []
+        for j in range(2 * half_taps):
+            distance = (j - half_taps + 1) - offset
+            if distance == 0:
+                value = cutoff
+            else:
+                value = math.sin(math.pi * cutoff * distance) / (math.pi * distance)
+            # Blackman window over [-half_taps, half_taps]
+            w = distance / half_taps
+            if abs(w) >= 1:
+                value = 0.0
+            else:
+                value *= 0.42 + 0.5 * math.cos(math.pi * w) + 0.08 * math.cos(2 * math.pi * w)
+            row.append(value)
+        gain = sum(row)
+        table.append([v / gain for v in row])
+
+    if np is not None:
+        table = np.array(table, dtype=np.float64)
+    return half_taps, phases, table
+
+def resample_stream(blocks, original_rate, target_rate, mode=DEFAULT_RESAMPLE_MODE):
+    resampler = StreamResampler(original_rate, target_rate, mode)
+    for block in blocks:
+        output = resampler.process(block)
+        if output:
+            yield output
+    output = resampler.flush()
+    if output:
+        yield output
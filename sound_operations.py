@@ -0,0 +1,553 @@
+import functools
+import os
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from dsp_codec import decodable_samples
+from file_operations import (
+    UberContainer, load_sound_data, build_rebuild_index, encode_wav_to_adpcm, encode_wav_to_adpcm_profiled,
+    write_wav, write_wav_stream, write_dsp_file, PatchPlan
+)
+from instrumentation import NULL_PROFILER
+from pcm_cache import DECODE_BATCH_SOUNDS
+from rebuild_manifest import RebuildManifest, manifest_path, pcm_hash, data_hash, source_hash
+from resampler import DEFAULT_RESAMPLE_MODE
+
+REBUILD_QUEUE_PER_WORKER = 2
+# Files being written at once during extraction; slow or network drives
+# need several requests in flight to reach their bandwidth.
+DEFAULT_WRITE_THREADS = 4
+
+class OperationCancelled(Exception):
+    pass
+
+def _ignore(*args):
+    pass
+
+def load_bank(uber_path, samp_path, profiler=NULL_PROFILER):
+    with UberContainer(uber_path) as container:
+        with profiler.stage("read_uber", len(container.data)):
+            sdir = container.sdir
+
+        if sdir is None:
+            raise ValueError("Could not find SDIR chunk in UBER file")
+
+        with profiler.stage("scan_sdir", len(sdir)):
+            sounds = load_sound_data(sdir, samp_path)
+        with profiler.stage("rebuild_index"):
+            rebuild_index = build_rebuild_index(container.sdir_offset, sounds)
+
+    return sounds, rebuild_index
+
+def sound_file_path(base_name, sound_info, extension):
+    return f"{base_name}_{sound_info.index:02d}.{extension}"
+
+def extract_wavs(sounds, base_name, pcm_cache, log=_ignore, progress=_ignore, start_seconds=0, end_seconds=None,
+                 profiler=NULL_PROFILER, exports=None, writers=DEFAULT_WRITE_THREADS, decode_workers=1):
+    extracted_sounds = []
+    total = len(sounds)
+    sounds, duplicates = _claim_exports(sounds, base_name, "wav", exports)
+
+    # Whole sounds are decoded side by side in batches, on a process pool
+    # once there is more than one batch; a time range is streamed per sound
+    # so only the requested frames are decoded.
+    decoder = None
+    ranged = start_seconds or end_seconds is not None
+    if ranged:
+        sources = ((sound_info, None) for sound_info in sounds)
+        manifest = None
+    else:
+        if decode_workers > 1 and len(sounds) > DECODE_BATCH_SOUNDS:
+            decoder = ProcessPoolExecutor(max_workers=decode_workers)
+        # Sounds are decoded a batch at a time, so decode time is not per sound
+        sources = profiler.timed("decode", pcm_cache.iter_pcm(sounds, executor=decoder, prefetch=decode_workers),
+                                 lambda item: len(item[0].adpcm_data))
+        manifest = RebuildManifest.load(manifest_path(base_name))
+
+    def write(sound_info, pcm_samples):
+        wav_path = sound_file_path(base_name, sound_info, "wav")
+        source = None
+        with profiler.sound(sound_info.index):
+            if pcm_samples is not None:
+                with profiler.stage("write_wav", len(pcm_samples) * 2):
+                    write_wav(wav_path, pcm_samples, sound_info.sample_rate)
+            else:
+                write_wav_range(wav_path, sound_info, pcm_cache, start_seconds, end_seconds, profiler)
+
+            if manifest is not None:
+                # An untouched WAV can then be left out of the next rebuild
+                with profiler.stage("hash", len(pcm_samples) * 2):
+                    source = ('wav', pcm_hash([pcm_samples], sound_info.sample_rate), sound_info.sample_rate)
+        return sound_info, wav_path, source
+
+    writes = _run_writes((functools.partial(write, *item) for item in sources), writers)
+    try:
+        for done, (sound_info, wav_path, source) in enumerate(writes, 1):
+            if source is not None:
+                manifest.record(sound_info.index, source, data_hash(sound_info.adpcm_data))
+            if exports is not None:
+                exports.finish(sound_info, "wav", wav_path, source)
+            # Only the index and path are kept; the entry itself holds a view
+            # into the mapped SAMP
+            extracted_sounds.append((sound_info.index, wav_path))
+
+            log(f"\nExtracted Sound {sound_info.index:02d}: {os.path.basename(wav_path)}")
+            log(f"\n  Sample Rate: {sound_info.sample_rate} Hz")
+            log(f"\n  Duration: {sound_info.duration:.2f}s\n")
+            progress(done, total)
+
+        def write_missing(sound_info):
+            return write(sound_info, None if ranged else pcm_cache.get(sound_info))
+
+        extracted_sounds += _link_duplicates(duplicates, base_name, "wav", exports, manifest, write_missing,
+                                             log, progress, len(sounds), total, profiler)
+    finally:
+        writes.close()
+        if decoder is not None:
+            decoder.shutdown(cancel_futures=True)
+        # Kept even when cancelled, for the sounds already written
+        if manifest is not None:
+            _save_manifest(manifest, log)
+        if exports is not None:
+            exports.release()
+            _save_duplicates(exports, base_name, log)
+
+    return extracted_sounds
+
+def _run_writes(tasks, writers):
+    # Runs file writing tasks on a thread pool with at most `writers` in
+    # flight and yields their results in the order they finish. Closing the
+    # generator drops the queued tasks and waits for the running ones, so no
+    # file is left half-written.
+    if writers <= 1:
+        for task in tasks:
+            yield task()
+        return
+
+    executor = ThreadPoolExecutor(max_workers=writers)
+    pending = set()
+    try:
+        for task in tasks:
+            while len(pending) >= writers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+            pending.add(executor.submit(task))
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+def _claim_exports(sounds, base_name, extension, exports):
+    # Splits off the sounds whose payload was already written for another
+    # sound; they are linked once the rest have been written.
+    if exports is None:
+        return sounds, []
+
+    to_write = []
+    duplicates = []
+    for sound_info in sounds:
+        original_path = exports.claim(sound_info, sound_file_path(base_name, sound_info, extension), extension)
+        if original_path is None:
+            to_write.append(sound_info)
+        else:
+            duplicates.append((sound_info, original_path))
+    return to_write, duplicates
+
+def _link_duplicates(duplicates, base_name, extension, exports, manifest, write, log, progress, done, total,
+                     profiler):
+    linked_sounds = []
+    for sound_info, original_path in duplicates:
+        path = sound_file_path(base_name, sound_info, extension)
+
+        try:
+            with profiler.sound(sound_info.index):
+                with profiler.stage("link"):
+                    linked = exports.link(original_path, path, base_name)
+        except FileNotFoundError:
+            # The first copy is gone, so this one is written and later
+            # repeats are linked to it instead
+            _, path, source = write(sound_info)
+            exports.finish(sound_info, extension, path, source)
+            if manifest is not None and source is not None:
+                manifest.record(sound_info.index, source, data_hash(sound_info.adpcm_data))
+            linked_sounds.append((sound_info.index, path))
+            log(f"\nExtracted Sound {sound_info.index:02d}: {os.path.basename(path)} ({original_path} was missing)\n")
+            done += 1
+            progress(done, total)
+            continue
+
+        source = exports.source(sound_info, extension)
+        if linked and manifest is not None and source is not None:
+            manifest.record(sound_info.index, source, data_hash(sound_info.adpcm_data))
+        linked_sounds.append((sound_info.index, path))
+
+        action = "Linked" if linked else "Listed"
+        log(f"\n{action} Sound {sound_info.index:02d}: {os.path.basename(path)} (same audio as {original_path})\n")
+        done += 1
+        progress(done, total)
+    return linked_sounds
+
+def _save_duplicates(exports, base_name, log):
+    try:
+        path = exports.save_duplicates(base_name)
+    except OSError as e:
+        log(f"\nCould not save duplicates manifest: {str(e)}")
+        return
+    if path is not None:
+        log(f"\nDuplicate sounds are listed in {os.path.basename(path)}")
+
+def _save_manifest(manifest, log):
+    try:
+        manifest.save()
+    except OSError as e:
+        log(f"\nCould not save rebuild manifest: {str(e)}")
+
+def write_wav_range(wav_path, sound_info, pcm_cache, start_seconds, end_seconds=None, profiler=NULL_PROFILER):
+    sample_rate = sound_info.sample_rate
+    total = decodable_samples(len(sound_info.adpcm_data), sound_info.num_samples)
+    start = min(total, int(start_seconds * sample_rate))
+    end = total if end_seconds is None else max(start, min(total, int(end_seconds * sample_rate)))
+
+    chunks = profiler.timed("decode", pcm_cache.iter_range(sound_info, start, end), lambda chunk: len(chunk) * 2)
+    with profiler.stage("write_wav", (end - start) * 2):
+        write_wav_stream(wav_path, chunks, end - start, sample_rate)
+
+def extract_dsps(sounds, base_name, log=_ignore, progress=_ignore, profiler=NULL_PROFILER, exports=None,
+                 writers=DEFAULT_WRITE_THREADS):
+    total = len(sounds)
+    sounds, duplicates = _claim_exports(sounds, base_name, "dsp", exports)
+    manifest = RebuildManifest.load(manifest_path(base_name))
+
+    def write(sound_info):
+        dsp_path = sound_file_path(base_name, sound_info, "dsp")
+        with profiler.sound(sound_info.index):
+            dsp_header = sound_info.dsp_header
+            with profiler.stage("write_dsp", len(dsp_header) + len(sound_info.adpcm_data)):
+                write_dsp_file(dsp_path, dsp_header, sound_info.adpcm_data)
+            with profiler.stage("hash"):
+                source = ('dsp', data_hash(dsp_header, sound_info.adpcm_data), None)
+        return sound_info, dsp_path, source
+
+    writes = _run_writes((functools.partial(write, sound_info) for sound_info in sounds), writers)
+    try:
+        for done, (sound_info, dsp_path, source) in enumerate(writes, 1):
+            manifest.record(sound_info.index, source, data_hash(sound_info.adpcm_data))
+            if exports is not None:
+                exports.finish(sound_info, "dsp", dsp_path, source)
+
+            log(f"\nExtracted Sound {sound_info.index:02d}: {os.path.basename(dsp_path)}")
+            log(f"\n  Sample Rate: {sound_info.sample_rate} Hz")
+            log(f"\n  Duration: {sound_info.duration:.2f}s\n")
+            progress(done, total)
+
+        _link_duplicates(duplicates, base_name, "dsp", exports, manifest, write, log, progress, len(sounds), total,
+                         profiler)
+    finally:
+        writes.close()
+        _save_manifest(manifest, log)
+        if exports is not None:
+            exports.release()
+            _save_duplicates(exports, base_name, log)
+
+def find_rebuild_sources(sounds, base_name):
+    sources = []
+    for sound_info in sounds:
+        wav_path = sound_file_path(base_name, sound_info, "wav")
+        dsp_path = sound_file_path(base_name, sound_info, "dsp")
+
+        if os.path.exists(wav_path) or os.path.exists(dsp_path):
+            rebuild_info = {
+                'index': sound_info.index,
+                'wav_path': wav_path,
+                'dsp_path': dsp_path,
+                'coefficients': sound_info.coefficients,
+                'ps': sound_info.ps,
+                'adpcm_data': sound_info.adpcm_data,
+                'sample_rate': sound_info.sample_rate
+            }
+            sources.append(rebuild_info)
+    return sources
+
+def plan_rebuild(uber_path, samp_path, sources, rebuild_index, workers=1, log=_ignore, progress=_ignore,
+                 resample_mode=DEFAULT_RESAMPLE_MODE, profiler=NULL_PROFILER, manifest=None):
+    # Three stages joined by a bounded queue: a reader thread hashes and
+    # reads sources, the pool encodes WAVs, and this thread plans patches in
+    # index order. At most REBUILD_QUEUE_PER_WORKER sounds per worker are
+    # in flight, so a fast reader cannot buffer the whole container.
+    executor = None
+    items = queue.Queue(maxsize=max(2, workers * REBUILD_QUEUE_PER_WORKER))
+    stop = threading.Event()
+    reader = None
+    try:
+        # Sounds whose SDIR entries share SAMP bytes are rebuilt together: if
+        # one of them changed, leaving another out would let a later rebuild
+        # write its old audio back over the shared bytes.
+        states = {}
+        if manifest is not None and rebuild_index:
+            for group in _alias_groups(sources, rebuild_index):
+                for s in group:
+                    states[s['index']] = _source_state(s, manifest, resample_mode, profiler)
+                if not all(states[s['index']][1] for s in group):
+                    for s in group:
+                        states[s['index']] = (states[s['index']][0], False)
+
+        wav_count = sum(1 for s in sources if os.path.exists(s['wav_path']))
+        if workers > 1 and wav_count > 1:
+            executor = ProcessPoolExecutor(max_workers=min(workers, wav_count))
+
+        reader = threading.Thread(target=_read_rebuild_sources,
+                                  args=(sources, manifest, resample_mode, executor, items, stop, profiler, states),
+                                  daemon=True)
+        reader.start()
+
+        # Patches are only planned inside the loop; both files are rewritten
+        # once at the end so a failure part-way leaves them untouched.
+        patch_plan = PatchPlan()
+        if rebuild_index is None:
+            log("SDIR index unavailable - falling back to pattern search\n")
+
+        converted_count = 0
+        unchanged_count = 0
+        samp_claims = {}
+        for progress_idx in range(len(sources)):
+            kind, sound_info, source, payload = items.get()
+            if kind == 'error':
+                raise payload
+            index = sound_info['index']
+
+            if kind == 'unchanged':
+                log(f"\nSkipped Sound {index:02d}: Unchanged since it was last extracted or rebuilt")
+                unchanged_count += 1
+                progress(progress_idx + 1, len(sources))
+                continue
+
+            if kind == 'missing':
+                log(f"\nSkipped Sound {index:02d}: Neither WAV nor DSP file found")
+                continue
+
+            log(f"\n\nProcessing Sound {index:02d}")
+
+            if kind == 'dsp':
+                log(f": Using existing DSP file")
+                log(f"\n  Step 1: Loaded existing DSP ({len(payload)} bytes)")
+                replacement_data = payload[0x1C:0x3C]
+                new_audio_data = payload[0x60:]
+            else:
+                log(f": {os.path.basename(sound_info['wav_path'])}")
+
+                if payload is not None:
+                    # Time spent here is the pool running behind the patch planning
+                    with profiler.stage("encode_wait", sound=index):
+                        result = payload.result()
+                    if profiler.enabled:
+                        result, records = result
+                        profiler.merge(records)
+                    num_samples, wav_sample_rate, adpcm_data = result
+                else:
+                    with profiler.sound(index):
+                        num_samples, wav_sample_rate, adpcm_data = encode_wav_to_adpcm(
+                            sound_info['wav_path'], sound_info['sample_rate'], sound_info['coefficients'],
+                            resample_mode, profiler)
+
+                if wav_sample_rate != sound_info['sample_rate']:
+                    log(f"\n  Resampled from {wav_sample_rate} Hz to {sound_info['sample_rate']} Hz ({resample_mode})")
+
+                # The coefficients and payload go straight into the patches;
+                # no DSP file is written for a WAV.
+                log(f"\n  Step 1: Encoded {num_samples} samples to DSP ({len(adpcm_data)} bytes of ADPCM)")
+                replacement_data = sound_info['coefficients']
+                new_audio_data = adpcm_data
+
+            index_entry = rebuild_index.get(index) if rebuild_index else None
+
+            if index_entry is not None:
+                uber_offset = index_entry['uber_offset']
+                log(f"\n  Step 2: Coefficients located via SDIR at UBER offset 0x{uber_offset:X}")
+            else:
+                log(f"\n  Step 2: Searching for pattern in UBER (bytes 0x1C-0x3B)...")
+                with profiler.stage("pattern_search", sound=index):
+                    uber_offset = patch_plan.find_unclaimed(uber_path, sound_info['coefficients'])
+
+            if uber_offset is not None:
+                patch_plan.add(uber_path, uber_offset, replacement_data)
+                log(f"\n  Step 3: Queued UBER patch at offset 0x{uber_offset:X}")
+            else:
+                log(f"\n  Step 3: Pattern not found in UBER - skipping UBER patch")
+
+            original_length = len(sound_info['adpcm_data'])
+            if index_entry is not None:
+                samp_offset = index_entry['samp_offset']
+                log(f"\n  Step 4: Audio data located via SDIR at SAMP offset 0x{samp_offset:X}")
+            else:
+                log(f"\n  Step 4: Searching for audio data in SAMP (from offset 0x60)...")
+                with profiler.stage("pattern_search", sound=index):
+                    samp_offset = patch_plan.find_unclaimed(samp_path, sound_info['adpcm_data'])
+
+            if samp_offset is not None:
+                new_length = len(new_audio_data)
+
+                if new_length < original_length:
+                    padding_needed = original_length - new_length
+                    new_audio_data = new_audio_data + (b'\x00' * padding_needed)
+                    log(f"\n  Step 5: Added {padding_needed} bytes padding to match original length")
+                elif new_length > original_length:
+                    new_audio_data = new_audio_data[:original_length]
+                    log(f"\n  Step 5: Trimmed {new_length - original_length} bytes to match original length")
+                else:
+                    log(f"\n  Step 5: Length matches exactly ({new_length} bytes)")
+
+                aliased = samp_claims.get(samp_offset)
+                if aliased is not None and aliased[1] != new_audio_data:
+                    raise ValueError(
+                        f"Sounds {aliased[0]:02d} and {index:02d} share the same audio data in the SAMP "
+                        f"(offset 0x{samp_offset:X}), but their edited files differ. Make their files identical, "
+                        f"or remove all but one of them, and rebuild again.")
+                samp_claims[samp_offset] = (index, bytes(new_audio_data))
+
+                patch_plan.add(samp_path, samp_offset, new_audio_data)
+                log(f"\n  Step 6: Queued SAMP patch at offset 0x{samp_offset:X}")
+
+                if manifest is not None and source is not None:
+                    manifest.stage(index, source, data_hash(new_audio_data),
+                                   _manifest_resample_mode(source, sound_info, resample_mode))
+            else:
+                log(f"\n  Step 5: Audio data not found in SAMP - skipping SAMP patch")
+
+            converted_count += 1
+            progress(progress_idx + 1, len(sources))
+
+        if unchanged_count:
+            log(f"\n\nSkipped {unchanged_count} unchanged sound(s)")
+        log(f"\n\nWriting {patch_plan.count(uber_path)} UBER and {patch_plan.count(samp_path)} SAMP patch(es)...")
+        return patch_plan, converted_count
+    finally:
+        stop.set()
+        if reader is not None:
+            reader.join()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+def _alias_groups(sources, rebuild_index):
+    by_offset = {}
+    for s in sources:
+        entry = rebuild_index.get(s['index'])
+        if entry is not None:
+            by_offset.setdefault(entry['samp_offset'], []).append(s)
+    return [group for group in by_offset.values() if len(group) > 1]
+
+def _source_state(s, manifest, resample_mode, profiler):
+    # (source hash, whether the SAMP still holds what the source encodes to)
+    with profiler.stage("hash", sound=s['index']):
+        source = source_hash(s['wav_path'], s['dsp_path'])
+        current = manifest.is_current(s['index'], source, data_hash(s['adpcm_data']),
+                                      _manifest_resample_mode(source, s, resample_mode))
+    return source, current
+
+def _read_rebuild_sources(sources, manifest, resample_mode, executor, items, stop, profiler, states):
+    # Reader stage of plan_rebuild: queues (kind, source info, source hash,
+    # payload) per sound in order, where the payload is the encode future
+    # for a WAV (None when encoding inline) or the bytes of a DSP.
+    try:
+        for s in sources:
+            if stop.is_set():
+                return
+            index = s['index']
+
+            # Sounds whose WAV or DSP still matches what was last extracted
+            # from, or rebuilt into, the current SAMP bytes are left as they are.
+            source = None
+            if manifest is not None:
+                state = states.get(index)
+                source, current = state if state is not None else _source_state(s, manifest, resample_mode,
+                                                                                 profiler)
+                if current:
+                    _put_item(items, stop, ('unchanged', s, source, None))
+                    continue
+
+            if os.path.exists(s['wav_path']):
+                job = None
+                if executor is not None and profiler.enabled:
+                    job = executor.submit(encode_wav_to_adpcm_profiled, s['wav_path'], s['sample_rate'],
+                                          s['coefficients'], resample_mode, index, profiler.trace_memory)
+                elif executor is not None:
+                    job = executor.submit(encode_wav_to_adpcm, s['wav_path'], s['sample_rate'], s['coefficients'],
+                                          resample_mode)
+                item = ('wav', s, source, job)
+            elif os.path.exists(s['dsp_path']):
+                with profiler.stage("read_dsp", sound=index) as stage:
+                    with open(s['dsp_path'], 'rb') as dsp:
+                        dsp_data = dsp.read()
+                    stage.bytes = len(dsp_data)
+                item = ('dsp', s, source, dsp_data)
+            else:
+                item = ('missing', s, source, None)
+            _put_item(items, stop, item)
+    except BaseException as e:
+        _put_item(items, stop, ('error', None, None, e))
+
+def _put_item(items, stop, item):
+    # Blocks while the queue is full, but gives up once the consumer stops
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+def _manifest_resample_mode(source, sound_info, resample_mode):
+    # Only matters for a WAV that has to be resampled
+    if source is None or source[2] is None or source[2] == sound_info['sample_rate']:
+        return None
+    return resample_mode
+
+def finish_rebuild(patch_plan, converted_count, log=_ignore, profiler=NULL_PROFILER, manifest=None):
+    patched = bool(patch_plan.patches)
+
+    # Each patched file is rewritten in full
+    with profiler.stage("patch_files", sum(os.path.getsize(path) for path in patch_plan.patches)):
+        patch_plan.commit()
+    if manifest is not None:
+        try:
+            manifest.commit()
+        except OSError as e:
+            log(f"\nCould not save rebuild manifest: {str(e)}")
+
+    log(f"\n\n{'='*53}\nRebuild complete! Processed {converted_count} sound(s).")
+    if patched:
+        log(f"\nUBER and SAMP files have been patched with new audio data.")
+    else:
+        log(f"\nNo sound changed, so the UBER and SAMP files were left as they are.")
+
+def rebuild_container(uber_path, samp_path, workers=1, log=_ignore, progress=_ignore,
+                      resample_mode=DEFAULT_RESAMPLE_MODE, profiler=NULL_PROFILER, incremental=True,
+                      base_name=None):
+    # base_name is where the edited files (and the rebuild manifest) live,
+    # next to the UBER unless they were extracted somewhere else.
+    sounds, rebuild_index = load_bank(uber_path, samp_path, profiler)
+    if base_name is None:
+        base_name = os.path.splitext(uber_path)[0]
+    sources = find_rebuild_sources(sounds, base_name)
+    sounds = None
+
+    if not sources:
+        log("\nNo WAV or DSP files found for rebuilding.")
+        return 0
+
+    log("\nStarting rebuild with UBER and SAMP patching...\n")
+    log(f"Found {len(sources)} sound(s) to rebuild\n")
+
+    # A full rebuild starts from an empty manifest, so nothing is skipped
+    # but every rebuilt sound is still recorded for next time.
+    if incremental:
+        manifest = RebuildManifest.load(manifest_path(base_name))
+    else:
+        manifest = RebuildManifest(manifest_path(base_name))
+    patch_plan, converted_count = plan_rebuild(uber_path, samp_path, sources, rebuild_index,
+                                               workers, log, progress, resample_mode, profiler, manifest)
+    sources = None
+    finish_rebuild(patch_plan, converted_count, log, profiler, manifest)
+    return converted_count
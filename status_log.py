@@ -0,0 +1,70 @@
+import threading
+import tkinter as tk
+
+DEFAULT_STATUS_LINES = 5000
+STATUS_FLUSH_MS = 100
+# Pending messages are folded down to the visible tail once this many
+# pile up, so a stalled UI cannot make the buffer grow without limit.
+MAX_PENDING_MESSAGES = 4096
+
+class StatusLog:
+    # Collects status messages from any thread and writes them to the
+    # widget in one insert per tick, keeping only the most recent lines.
+    def __init__(self, root, widget, max_lines=DEFAULT_STATUS_LINES, flush_ms=STATUS_FLUSH_MS, mirror_path=None):
+        self.root = root
+        self.widget = widget
+        self.max_lines = max_lines
+        self.flush_ms = flush_ms
+        self.pending = []
+        self.lock = threading.Lock()
+        self.mirror = open(mirror_path, 'a', encoding='utf-8') if mirror_path else None
+        self.root.after(self.flush_ms, self.tick)
+
+    def write(self, text):
+        with self.lock:
+            self.pending.append(text)
+            if self.mirror is not None:
+                self.mirror.write(text)
+            if len(self.pending) > MAX_PENDING_MESSAGES:
+                self.pending = [self._tail("".join(self.pending))]
+
+    def clear(self):
+        with self.lock:
+            self.pending = []
+        self.widget.delete(1.0, tk.END)
+
+    def tick(self):
+        try:
+            self.flush()
+        finally:
+            self.root.after(self.flush_ms, self.tick)
+
+    def flush(self):
+        with self.lock:
+            text = "".join(self.pending)
+            self.pending = []
+            if self.mirror is not None:
+                self.mirror.flush()
+        if not text:
+            return
+
+        self.widget.insert(tk.END, self._tail(text))
+
+        lines = int(self.widget.index('end-1c').split('.')[0])
+        if lines > self.max_lines:
+            self.widget.delete(1.0, f"{lines - self.max_lines + 1}.0")
+
+    def _tail(self, text):
+        # Only the lines that would survive trimming are worth inserting
+        cut = len(text)
+        for _ in range(self.max_lines):
+            cut = text.rfind("\n", 0, cut)
+            if cut < 0:
+                return text
+        return text[cut + 1:]
+
+    def close(self):
+        with self.lock:
+            if self.mirror is not None:
+                self.mirror.close()
+                self.mirror = None
@@ -0,0 +1,138 @@
+import argparse
+import math
+import os
+import random
+import struct
+from array import array
+
+from dsp_codec import encode_dsp_adpcm
+from file_operations import SDIR_ENTRY
+
+# Predictor pairs in the 11-bit fixed point the SDIR stores, modelled on the
+# tables GameCube tools usually emit.
+COEFFICIENT_SETS = [
+    [(2048, 0), (0, 0), (4096, -2048), (3584, -1536), (3072, -1024), (4608, -2560), (4200, -2248), (4800, -2300)],
+    [(1600, 200), (3900, -1900), (2600, -700), (4400, -2500), (1000, 600), (3300, -1500), (3700, -1700), (200, 300)],
+]
+SAMPLE_RATES = (32000, 22050)
+SAMP_ALIGNMENT = 32
+SINE_TABLE_BITS = 12
+SINE_TABLE = [round(math.sin(2 * math.pi * i / (1 << SINE_TABLE_BITS)) * 32767)
+              for i in range(1 << SINE_TABLE_BITS)]
+
+def pack_coefficients(pairs):
+    return struct.pack(">16h", *[c for pair in pairs for c in pair])
+
+def synthesize(num_samples, sample_rate, rng):
+    # A few partials plus noise, using an integer phase accumulator
+    # so the same seed yields the same samples on every platform.
+    partials = []
+    for _ in range(rng.randint(1, 4)):
+        frequency = rng.uniform(60, min(6000, sample_rate / 3))
+        step = int(frequency * (1 << 32) / sample_rate)
+        partials.append((step, rng.randint(1000, 9000)))
+    noise = rng.randint(0, 1500)
+    fade_out = rng.random() < 0.5
+
+    samples = array('h', bytes(num_samples * 2))
+    phases = [0] * len(partials)
+    shift = 32 - SINE_TABLE_BITS
+    for i in range(num_samples):
+        value = 0
+        for p, (step, amplitude) in enumerate(partials):
+            value += SINE_TABLE[phases[p] >> shift] * amplitude >> 15
+            phases[p] = (phases[p] + step) & 0xFFFFFFFF
+        if noise:
+            value += rng.randint(-noise, noise)
+        if fade_out:
+            value = value * (num_samples - i) // num_samples
+        samples[i] = max(-32768, min(32767, value))
+    return samples
+
+def build_source_streams(seconds, rng):
+    # One long encoded stream per coefficient set; sounds are frame-aligned
+    # slices of these, so large banks cost no extra encoding.
+    streams = []
+    for pairs in COEFFICIENT_SETS:
+        coefficients = pack_coefficients(pairs)
+        pcm = array('h')
+        while len(pcm) < seconds * max(SAMPLE_RATES):
+            pcm.extend(synthesize(rng.randint(4000, 40000), max(SAMPLE_RATES), rng))
+        streams.append((coefficients, bytes(encode_dsp_adpcm(pcm, coefficients))))
+    return streams
+
+def generate_bank(directory, name, num_sounds, seed=0, min_seconds=0.2, max_seconds=8.0, long_sounds=0,
+                  long_seconds=90.0):
+    rng = random.Random(seed)
+    source_seconds = max(max_seconds, long_seconds if long_sounds else 0) + 1
+    streams = build_source_streams(source_seconds, rng)
+
+    samp = bytearray()
+    entries = bytearray()
+    long_indices = set(rng.sample(range(num_sounds), min(long_sounds, num_sounds)))
+
+    for index in range(num_sounds):
+        coefficients, stream = rng.choice(streams)
+        sample_rate = rng.choice(SAMPLE_RATES)
+        seconds = long_seconds if index in long_indices else rng.uniform(min_seconds, max_seconds)
+        frames = max(1, min(len(stream) // 8, int(seconds * sample_rate) // 14))
+        start = rng.randint(0, len(stream) // 8 - frames)
+        adpcm = stream[start * 8:(start + frames) * 8]
+
+        samp_offset = len(samp)
+        samp += adpcm
+        samp += b"\0" * (-len(samp) % SAMP_ALIGNMENT)
+
+        num_nibbles = frames * 16
+        entry = SDIR_ENTRY.pack(samp_offset * 2 + 2, num_nibbles, sample_rate, coefficients, adpcm[0])
+        # Sound id in the otherwise unused bytes after the nibble count
+        entries += entry[:8] + struct.pack(">H", index) + entry[10:]
+
+    sdir = b"RIDS" + struct.pack(">III", 1, len(entries) + 16, num_sounds) + entries
+    chunks = [
+        b"JORP" + struct.pack(">I", num_sounds) + bytes(24),
+        b"LOOP" + bytes(rng.getrandbits(8) for _ in range(60)),
+        sdir,
+        b"EPYT" + bytes(12),
+    ]
+
+    # The chunk table ends where the first chunk starts, so only the chunks
+    # after it are aligned.
+    header_size = 0x08 + 4 * len(chunks)
+    body = bytearray()
+    offsets = []
+    for chunk in chunks:
+        if body:
+            body += b"\0" * (-(header_size + len(body)) % 16)
+        offsets.append(header_size + len(body))
+        body += chunk
+
+    uber = b"UBER" + struct.pack(">I", 1) + struct.pack(f">{len(offsets)}I", *offsets) + body
+
+    uber_path = os.path.join(directory, name + ".uber")
+    samp_path = os.path.join(directory, name + ".samp")
+    with open(uber_path, "wb") as f:
+        f.write(uber)
+    with open(samp_path, "wb") as f:
+        f.write(samp)
+    return uber_path, samp_path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic UBER/SAMP pair for testing and benchmarks.")
+    parser.add_argument("directory")
+    parser.add_argument("--name", default="Synthetic")
+    parser.add_argument("--sounds", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--min-seconds", type=float, default=0.2)
+    parser.add_argument("--max-seconds", type=float, default=8.0)
+    parser.add_argument("--long-sounds", type=int, default=0, help="number of music-length sounds to include")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.directory, exist_ok=True)
+    uber_path, samp_path = generate_bank(args.directory, args.name, args.sounds, args.seed,
+                                         args.min_seconds, args.max_seconds, args.long_sounds)
+    print(uber_path)
+    print(samp_path)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import json
+import os
+import shutil
+
+from instrumentation import NULL_PROFILER
+from pcm_cache import pcm_content_key
+from sound_operations import load_bank
+
+DEDUPE_MODES = ("link", "manifest")
+
+def duplicates_path(base_name):
+    return base_name + ".duplicates.json"
+
+class ExportIndex:
+    # Remembers every file written for a payload during one extraction so a
+    # sound that repeats it, in the same container or another one, is linked
+    # to that file (or listed in a duplicates manifest) instead of written.
+    def __init__(self, mode="link"):
+        if mode not in DEDUPE_MODES:
+            raise ValueError(f"Unknown dedupe mode: {mode}")
+        self.mode = mode
+        self.exports = {}
+        self.duplicates = {}
+        self.written = 0
+        self.linked = 0
+        self.listed = 0
+        self.saved_bytes = 0
+
+    def _key(self, sound_info, extension):
+        # The sample rate is part of both the WAV and the DSP header
+        return pcm_content_key(sound_info), sound_info.sample_rate, extension
+
+    def claim(self, sound_info, path, extension):
+        # Returns the path already claimed for this payload, or None if this
+        # sound is the first and must be written to path.
+        key = self._key(sound_info, extension)
+        export = self.exports.get(key)
+        if export is not None:
+            return export['path']
+        self.exports[key] = {'path': path, 'source': None, 'written': False}
+        return None
+
+    def finish(self, sound_info, extension, path, source):
+        # Called once the file for a claimed payload is on disk
+        export = self.exports[self._key(sound_info, extension)]
+        export.update(path=path, source=source, written=True)
+        self.written += 1
+
+    def release(self):
+        # Drops the claims whose file was never written, after a container
+        # failed part-way, so later containers write those payloads instead.
+        self.exports = {key: export for key, export in self.exports.items() if export['written']}
+
+    def source(self, sound_info, extension):
+        return self.exports[self._key(sound_info, extension)]['source']
+
+    def link(self, original_path, path, base_name):
+        # Returns True if a file now exists at path. Raises FileNotFoundError
+        # if the original is gone, so the caller writes the file itself.
+        size = os.path.getsize(original_path)
+        if self.mode == "manifest":
+            self.duplicates.setdefault(base_name, {})[os.path.basename(path)] = os.path.relpath(
+                original_path, os.path.dirname(path))
+            self.listed += 1
+            self.saved_bytes += size
+            return False
+
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(original_path, path)
+            self.saved_bytes += size
+        except OSError:
+            # Filesystems without hard links still get a real file
+            shutil.copyfile(original_path, path)
+        self.linked += 1
+        return True
+
+    def save_duplicates(self, base_name):
+        duplicates = self.duplicates.pop(base_name, None)
+        if not duplicates:
+            return None
+        path = duplicates_path(base_name)
+        with open(path, 'w') as f:
+            json.dump({'duplicates': duplicates}, f, indent=1, sort_keys=True)
+        return path
+
+class Workspace:
+    # Several UBER/SAMP pairs loaded side by side, with an index of which
+    # sounds share the same ADPCM payload across all of them.
+    def __init__(self):
+        self.banks = []
+        self.payloads = {}
+
+    def add(self, uber_path, samp_path, base_name, profiler=NULL_PROFILER):
+        sounds, _ = load_bank(uber_path, samp_path, profiler)
+        bank = {
+            'uber': uber_path,
+            'samp': samp_path,
+            'base_name': base_name,
+            'sounds': sounds
+        }
+        self.banks.append(bank)
+        with profiler.stage("hash", sum(len(sound_info.adpcm_data) for sound_info in sounds)):
+            for sound_info in sounds:
+                self.payloads.setdefault(pcm_content_key(sound_info), []).append((bank, sound_info))
+        return bank
+
+    def sound_count(self):
+        return sum(len(bank['sounds']) for bank in self.banks)
+
+    def unique_count(self):
+        return len(self.payloads)
+
+    def duplicate_groups(self):
+        return [sounds for sounds in self.payloads.values() if len(sounds) > 1]
+
+    def payload_bytes(self):
+        total = 0
+        unique = 0
+        for sounds in self.payloads.values():
+            size = len(sounds[0][1].adpcm_data)
+            total += size * len(sounds)
+            unique += size
+        return total, unique